@@ -1,9 +1,66 @@
-from gptscript.gptscript import GPTScript
-from gptscript.confirm import AuthResponse
-from gptscript.frame import RunFrame, CallFrame, PromptFrame, Program
-from gptscript.opts import GlobalOptions
-from gptscript.prompt import PromptResponse
-from gptscript.run import Run, RunBasicCommand, Options
-from gptscript.text import Text
-from gptscript.tool import ToolDef, Tool
-from gptscript.exec_utils import get_env
+import importlib
+from typing import TYPE_CHECKING
+
+# Names are imported from their submodules when they are first used, so that importing one of them doesn't pull in
+# httpx and pydantic, which tool processes that only need get_env would otherwise pay for on every start.
+_exports = {
+    "GPTScript": "gptscript.gptscript",
+    "BatchResult": "gptscript.batch",
+    "ResultCache": "gptscript.cache",
+    "AuthResponse": "gptscript.confirm",
+    "RunFrame": "gptscript.frame",
+    "CallFrame": "gptscript.frame",
+    "PromptFrame": "gptscript.frame",
+    "Program": "gptscript.frame",
+    "GlobalOptions": "gptscript.opts",
+    "Options": "gptscript.opts",
+    "PromptResponse": "gptscript.prompt",
+    "Run": "gptscript.run",
+    "RunBasicCommand": "gptscript.run",
+    "Text": "gptscript.text",
+    "ToolDef": "gptscript.tool",
+    "Tool": "gptscript.tool",
+    "Tracer": "gptscript.tracing",
+    "UsageLedger": "gptscript.usage",
+    "get_env": "gptscript.exec_utils",
+}
+
+__all__ = list(_exports)
+
+if TYPE_CHECKING:
+    from gptscript.gptscript import GPTScript
+    from gptscript.batch import BatchResult
+    from gptscript.cache import ResultCache
+    from gptscript.confirm import AuthResponse
+    from gptscript.frame import RunFrame, CallFrame, PromptFrame, Program
+    from gptscript.opts import GlobalOptions, Options
+    from gptscript.prompt import PromptResponse
+    from gptscript.run import Run, RunBasicCommand
+    from gptscript.text import Text
+    from gptscript.tool import ToolDef, Tool
+    from gptscript.tracing import Tracer
+    from gptscript.usage import UsageLedger
+    from gptscript.exec_utils import get_env
+
+
+def __getattr__(name: str):
+    module = _exports.get(name)
+    if module is None:
+        # Submodules, such as gptscript.opts, are imported when they are first used as attributes of the package.
+        if name in _submodules():
+            return importlib.import_module(f"{__name__}.{name}")
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def _submodules() -> set[str]:
+    import pkgutil
+
+    return {module.name for module in pkgutil.iter_modules(__path__)}
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
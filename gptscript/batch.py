@@ -0,0 +1,91 @@
+import asyncio
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable
+
+from gptscript.compact import Compact
+from gptscript.run import Run
+
+
+class BatchResult(Compact):
+    __slots__ = ("index", "input", "output", "error", "run")
+
+    def __init__(self,
+                 index: int = 0,
+                 input: str = "",
+                 output: str = "",
+                 error: str = "",
+                 run: Run | None = None,
+                 ):
+        # The position of the input in the batch.
+        self.index = index
+        self.input = input
+        self.output = output
+        # The error of the run for this input, or an empty string if it succeeded.
+        self.error = error
+        self.run = run
+
+
+async def batch(
+        start: Callable[[str], Run],
+        inputs: Iterable[str] | AsyncIterable[str],
+        concurrency: int = 10,
+        ordered: bool = False,
+) -> AsyncIterator[BatchResult]:
+    """
+    Start a run for every input with start, keeping at most concurrency runs in flight, and yield their results as they
+    finish. If ordered is True, results are yielded in input order; a slow run then holds back the results after it,
+    and those count against the concurrency limit. A failing run is reported in its result and doesn't stop the batch.
+    Inputs are read lazily, so inputs can be an unbounded iterable.
+    """
+    iterator = _aiter(inputs)
+    pending: set[asyncio.Task] = set()
+    finished: dict[int, BatchResult] = {}
+    next_index, next_result, exhausted = 0, 0, False
+    try:
+        while True:
+            while not exhausted and len(pending) + len(finished) < max(concurrency, 1):
+                try:
+                    input = await anext(iterator)
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.create_task(_run(start, next_index, input)))
+                next_index += 1
+
+            if not pending and not finished:
+                return
+
+            if pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    finished[result.index] = result
+
+            if ordered:
+                while next_result in finished:
+                    yield finished.pop(next_result)
+                    next_result += 1
+            else:
+                for index in list(finished):
+                    yield finished.pop(index)
+    finally:
+        # Cancelling these also cancels the runs they are waiting on.
+        for task in pending:
+            task.cancel()
+
+
+async def _run(start: Callable[[str], Run], index: int, input: str) -> BatchResult:
+    run = None
+    try:
+        run = start(input)
+        return BatchResult(index, input, output=await run.text(), run=run)
+    except Exception as e:
+        return BatchResult(index, input, error=str(e), run=run)
+
+
+async def _aiter(inputs: Iterable[str] | AsyncIterable[str]) -> AsyncIterator[str]:
+    if isinstance(inputs, AsyncIterable):
+        async for input in inputs:
+            yield input
+    else:
+        for input in inputs:
+            yield input
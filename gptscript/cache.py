@@ -0,0 +1,391 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from gptscript.opts import Options
+from gptscript.tool import ToolDef
+
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+
+class LRUCache:
+    """
+    An in-memory least-recently-used cache. Entries are evicted when there are more than max_entries of them or their
+    sizes add up to more than max_bytes (a limit of 0 means no limit), and expire ttl seconds after they are put
+    (0 means they don't expire).
+    """
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0, ttl: float = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[Any, int, float]] = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not _expired(entry[2])
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or _expired(entry[2]):
+            if entry is not None:
+                self.invalidate(key)
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, value: Any, size: int = 1, ttl: float = None):
+        self.invalidate(key)
+
+        ttl = self.ttl if ttl is None else ttl
+        self._entries[key] = (value, size, time.monotonic() + ttl if ttl > 0 else 0)
+        self._bytes += size
+        while self._entries and ((0 < self.max_entries < len(self._entries)) or (0 < self.max_bytes < self._bytes)):
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def invalidate(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def items(self) -> list[tuple[str, Any]]:
+        return [(key, entry[0]) for key, entry in self._entries.items() if not _expired(entry[2])]
+
+
+class ResultCache:
+    """
+    A cache of the results of runs, with an in-memory tier and an optional on-disk tier. Each tier is bounded by the
+    total size of its entries, and entries expire ttl seconds after they are put. The on-disk tier can be shared by
+    several processes.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 60 * 60, directory: str = "",
+                 max_disk_bytes: int = 1024 * 1024 * 1024):
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = LRUCache(max_bytes=max_bytes, ttl=ttl)
+        # The size of each file in the directory, oldest first, which is read from the directory when it is first
+        # written and before entries are evicted. Held while the directory is written, which can happen on other threads.
+        self._lock = threading.Lock()
+        self._files: dict[str, int] | None = None
+        self._disk_bytes = 0
+        if self.directory != "":
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        result = self._memory.get(key)
+        if result is None and self.directory != "":
+            result = self._read(key)
+            if result is not None:
+                self._memory.put(key, result, size=len(json.dumps(result)))
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: dict[str, Any], background: bool = False):
+        """
+        Put the result in both tiers. If background is True, which must be called from an event loop, the on-disk tier
+        is written on another thread, so the result is only in memory until that finishes.
+        """
+        data = json.dumps(result)
+        self._memory.put(key, result, size=len(data))
+        if self.directory == "":
+            return
+        if background:
+            asyncio.get_running_loop().run_in_executor(None, self._write, key, data)
+        else:
+            self._write(key, data)
+
+    def invalidate(self, key: str):
+        self._memory.invalidate(key)
+        if self.directory != "":
+            with self._lock:
+                self._remove(key + ".json")
+
+    def clear(self):
+        self._memory.clear()
+        if self.directory != "":
+            with self._lock:
+                for entry in os.scandir(self.directory):
+                    if entry.name.endswith(".json"):
+                        self._remove(entry.name)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def _read(self, key: str) -> dict[str, Any] | None:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if 0 < entry.get("expiresAt", 0) < time.time():
+            with self._lock:
+                self._remove(key + ".json")
+            return None
+        return entry.get("result")
+
+    def _write(self, key: str, data: str):
+        expires_at = time.time() + self.ttl if self.ttl > 0 else 0
+        content = f'{{"expiresAt": {expires_at}, "result": {data}}}'.encode("utf-8")
+
+        with self._lock:
+            if self._files is None:
+                self._scan()
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp, self._path(key))
+
+            name = key + ".json"
+            self._disk_bytes += len(content) - self._files.pop(name, 0)
+            self._files[name] = len(content)
+            if 0 < self.max_disk_bytes < self._disk_bytes:
+                # Other processes that share the directory write and evict entries too, so its size is read again.
+                self._scan()
+                self._evict_disk(keep=name)
+
+    def _scan(self):
+        # The caller holds the lock. Known files keep their place and size, and files written by other processes are
+        # added in the order they were written.
+        found = {e.name: e for e in os.scandir(self.directory) if e.name.endswith(".json")}
+        files = {name: size for name, size in (self._files or {}).items() if name in found}
+        added = []
+        for name, entry in found.items():
+            if name not in files:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                added.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(added):
+            files[name] = size
+        self._files = files
+        self._disk_bytes = sum(files.values())
+
+    def _evict_disk(self, keep: str):
+        for name in list(self._files):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            if name != keep:
+                self._remove(name)
+
+    def _remove(self, name: str):
+        # The caller holds the lock.
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return
+        if self._files is not None:
+            self._disk_bytes -= self._files.pop(name, 0)
+
+
+class LoadCache:
+    """
+    A cache of loaded programs and parsed nodes. Each entry records the local files it was loaded from, and is dropped
+    when the modification time or size of any of them changes. If watch is True, the directories of those files are
+    watched for changes instead, which saves checking the files on every lookup; this requires the watchfiles package.
+    """
+
+    def __init__(self, max_entries: int = 128, watch: bool = False):
+        if watch and watchfiles is None:
+            raise Exception("watching the files of the load cache requires the watchfiles package")
+
+        self.hits = 0
+        self.misses = 0
+        self._entries = LRUCache(max_entries=max_entries)
+        self._watch = watch
+        self._watched: set[str] = set()
+        self._watcher: asyncio.Task | None = None
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and not self._watch and any(_stamp(f) != stamp for f, stamp in entry[1].items()):
+            self._entries.invalidate(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, result: Any, files: list[str]):
+        files = {os.path.abspath(f): _stamp(f) for f in files}
+        self._entries.put(key, (result, files))
+        if self._watch:
+            directories = {os.path.dirname(f) for f in files} - self._watched
+            if directories:
+                self._watched |= directories
+                self._restart_watcher()
+
+    def invalidate(self, path: str = ""):
+        """Drop the entries loaded from the given file, or every entry if path is empty."""
+        if path == "":
+            self._entries.clear()
+            return
+
+        path = os.path.abspath(path)
+        for key, (_, files) in self._entries.items():
+            if path in files:
+                self._entries.invalidate(key)
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    def _restart_watcher(self):
+        self.close()
+        self._watcher = asyncio.create_task(self._watch_files(sorted(self._watched)))
+
+    async def _watch_files(self, directories: list[str]):
+        async for changes in watchfiles.awatch(*directories, recursive=False):
+            for _, path in changes:
+                self.invalidate(path)
+
+
+class RefreshCache:
+    """
+    A cache of values that are fetched with an async function. expiry returns the times, as returned by time.time(), at
+    which a value should be refreshed and at which it expires. A value is returned as is before its refresh time, and
+    returned while it is refreshed in the background between its refresh and expiry times, so callers only wait for a
+    fetch if there is no usable value. Concurrent fetches of the same key share one call of the fetch function.
+    """
+
+    def __init__(self, expiry: Callable[[Any], tuple[float, float]]):
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._expiry = expiry
+        self._entries: dict[str, tuple[Any, float, float]] = {}
+        self._fetches: dict[str, asyncio.Task] = {}
+        self._generation = 0
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None and now < entry[2]:
+            self.hits += 1
+            if now >= entry[1] and key not in self._fetches:
+                self.refreshes += 1
+                self._fetch(key, fetch)
+            return entry[0]
+
+        self.misses += 1
+        # Shielded so that a caller that is cancelled doesn't cancel the fetch for the other callers.
+        return await asyncio.shield(self._fetch(key, fetch))
+
+    def keys(self) -> list[str]:
+        return list(self._entries.keys() | self._fetches.keys())
+
+    def invalidate(self, key: str = ""):
+        """Drop the value of the given key, or every value if key is empty. Fetches in flight are not stored."""
+        self._generation += 1
+        if key == "":
+            self._entries.clear()
+            self._fetches.clear()
+        else:
+            self._entries.pop(key, None)
+            self._fetches.pop(key, None)
+
+    def _fetch(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._fetches.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.create_task(self._store(key, fetch, self._generation))
+            self._fetches[key] = task
+            # Background refreshes that fail leave the current value in place; the error is retrieved here so that it
+            # isn't reported as unhandled.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _store(self, key: str, fetch: Callable[[], Awaitable[Any]], generation: int) -> Any:
+        try:
+            value = await fetch()
+            if generation == self._generation:
+                refresh_at, expires_at = self._expiry(value)
+                self._entries[key] = (value, refresh_at, expires_at)
+            return value
+        finally:
+            if self._fetches.get(key) is asyncio.current_task():
+                del self._fetches[key]
+
+
+def load_key(kind: str, request_body: dict[str, Any]) -> str:
+    """Return the load cache key of a load or parse request. Content and tool definitions are keyed by their hash."""
+    return kind + ":" + hashlib.sha256(json.dumps(request_body, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def result_key(request_path: str, tools: ToolDef | list[ToolDef] | str, opts: Options) -> str:
+    """
+    Return the cache key of a run. The key covers the tools (or the path, modification time and size of a local tool
+    file), the input and the options that change the result of a run. The environment is not part of the key.
+    """
+    if isinstance(tools, str):
+        try:
+            stat = os.stat(tools)
+            tool_key = {"file": tools, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+        except OSError:
+            tool_key = {"file": tools}
+    else:
+        tool_key = [tool.to_json() for tool in (tools if isinstance(tools, list) else [tools])]
+
+    return hashlib.sha256(json.dumps({
+        "requestPath": request_path,
+        "tools": tool_key,
+        "input": opts.input,
+        "subTool": opts.subTool,
+        "chatState": opts.chatState,
+        "workspace": opts.workspace,
+        "location": opts.location,
+        "credentialOverrides": opts.credentialOverrides,
+        "credentialContexts": opts.credentialContexts,
+        "forceSequential": opts.forceSequential,
+        "baseURL": opts.BaseURL,
+        "defaultModel": opts.DefaultModel,
+        "defaultModelProvider": opts.DefaultModelProvider,
+    }, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _expired(expires_at: float) -> bool:
+    return 0 < expires_at < time.monotonic()
+
+
+def _stamp(path: str) -> tuple[int, int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,30 @@
+from typing import Any
+
+
+class _CompactType(type):
+    def __new__(mcs, name: str, bases: tuple[type, ...], namespace: dict[str, Any], **kwargs):
+        # A subclass without __slots__ would get an instance __dict__, which hides the __dict__ property of Compact, so
+        # it is given an empty one.
+        namespace.setdefault("__slots__", ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class Compact(metaclass=_CompactType):
+    """
+    Base class for model classes that store their attributes in __slots__ rather than a per-instance __dict__, which
+    saves a lot of memory when many instances are kept around. __dict__ and vars() still work, but they return a copy of
+    the attributes rather than the live namespace. Subclasses that don't declare __slots__ get an empty one, so new
+    attributes have to be declared in __slots__.
+    """
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(name for c in reversed(cls.__mro__) for name in vars(c).get("__slots__", ()))
+
+    def _asdict(self) -> dict[str, Any]:
+        return {name: getattr(self, name) for name in self._fields if hasattr(self, name)}
+
+    @property
+    def __dict__(self) -> dict[str, Any]:
+        return self._asdict()
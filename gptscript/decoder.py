@@ -0,0 +1,85 @@
+import json
+from typing import Any, Callable
+
+from gptscript.frame import CallFrame, LazyCallFrame, PromptFrame, RunFrame
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+def _default_loads() -> tuple[str, Callable[[bytes], Any]]:
+    if orjson is not None:
+        return "orjson", orjson.loads
+    if msgspec is not None:
+        return "msgspec", msgspec.json.Decoder().decode
+    return "json", _json_loads
+
+
+def _json_loads(data: bytes) -> Any:
+    # Decoding to a string first is faster than letting json.loads detect the encoding of the bytes.
+    return json.loads(data.decode("utf-8"))
+
+
+# The fastest JSON library that is installed is used to decode events. The standard library is used if neither orjson
+# nor msgspec is installed.
+json_backend, json_loads = _default_loads()
+
+
+class EventDecoder:
+    """
+    Decode server-sent events from the raw bytes of a response. Chunks are fed in as they arrive, and the decoded JSON
+    payloads of every complete event line are returned.
+    """
+
+    def __init__(self, loads: Callable[[bytes], Any] = None):
+        self._loads = loads if loads is not None else json_loads
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> list[Any]:
+        end = chunk.rfind(b"\n")
+        if end == -1:
+            self._buffer += chunk
+            return []
+
+        if self._buffer:
+            self._buffer += chunk[:end]
+            lines = self._buffer.split(b"\n")
+        else:
+            lines = chunk[:end].split(b"\n")
+        self._buffer = bytearray(chunk[end + 1:])
+
+        return [data for data in map(self._decode_line, lines) if data is not None]
+
+    def flush(self) -> list[Any]:
+        data = self._decode_line(self._buffer)
+        self._buffer = bytearray()
+        return [data] if data is not None else []
+
+    def _decode_line(self, line: bytes) -> Any:
+        line = line.strip()
+        if line.startswith(b"data:"):
+            line = line[5:].strip()
+        if not line or line == b'"[DONE]"':
+            return None
+        return self._loads(line)
+
+
+def to_frame(data: dict[str, Any], lazy: bool = False, drop_llm_payloads: bool = False) -> \
+        CallFrame | RunFrame | PromptFrame:
+    if "prompt" in data:
+        return PromptFrame(**data["prompt"])
+    elif "run" in data:
+        return RunFrame(**data["run"])
+
+    call = data["call"]
+    if drop_llm_payloads:
+        call.pop("llmRequest", None)
+        call.pop("llmResponse", None)
+    return LazyCallFrame(**call) if lazy else CallFrame(**call)
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from gptscript.compact import Compact
+from gptscript.frame import CallFrame, PromptFrame, RunFrame
+
+
+class HandlerMetrics(Compact):
+    __slots__ = ("events", "errors", "timeouts", "lastError", "totalLag", "maxLag", "cpuTime")
+
+    def __init__(self):
+        self.events = 0
+        self.errors = 0
+        self.timeouts = 0
+        # The exception raised by the latest handler that failed or timed out.
+        self.lastError: BaseException | None = None
+        # The time, in seconds, between receiving an event and starting its handlers.
+        self.totalLag = 0.0
+        self.maxLag = 0.0
+        # The CPU time, in seconds, spent running the handlers, not counting the time they are suspended.
+        self.cpuTime = 0.0
+
+    def avgLag(self) -> float:
+        return self.totalLag / self.events if self.events else 0.0
+
+
+class EventDispatcher:
+    """
+    Run event handlers with a limit on how many events are handled at once. Events of the same call are handled one at a
+    time in the order they were received; run and prompt events are ordered among themselves. Each handler invocation
+    can be given a timeout. If more than max_pending events are waiting to be handled, dispatch waits for room, which
+    slows down reading events from the server.
+    """
+
+    def __init__(self,
+                 run: Any,
+                 handlers: list[Callable[[Any, CallFrame | RunFrame | PromptFrame], Awaitable[None]]],
+                 concurrency: int = 10,
+                 timeout: float = 0,
+                 max_pending: int = 1000,
+                 ):
+        self._run = run
+        self._handlers = handlers
+        self._timeout = timeout if timeout > 0 else None
+        self._concurrency = asyncio.Semaphore(max(concurrency, 1))
+        self._pending = asyncio.Semaphore(max(max_pending, 1))
+        self._queues: dict[str, deque[tuple[CallFrame | RunFrame | PromptFrame, float]]] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self.metrics = HandlerMetrics()
+
+    async def dispatch(self, event: CallFrame | RunFrame | PromptFrame):
+        await self._pending.acquire()
+
+        key = event.id if isinstance(event, CallFrame) else ""
+        self._queues.setdefault(key, deque()).append((event, asyncio.get_running_loop().time()))
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key))
+
+    async def wait(self):
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def _work(self, key: str):
+        queue = self._queues[key]
+        try:
+            while queue:
+                event, received = queue.popleft()
+                try:
+                    async with self._concurrency:
+                        lag = asyncio.get_running_loop().time() - received
+                        self.metrics.events += 1
+                        self.metrics.totalLag += lag
+                        self.metrics.maxLag = max(self.metrics.maxLag, lag)
+                        await asyncio.gather(*[self._handle(handler, event) for handler in self._handlers])
+                finally:
+                    self._pending.release()
+        finally:
+            del self._workers[key]
+            del self._queues[key]
+
+    async def _handle(self, handler: Callable[[Any, Any], Awaitable[None]], event: CallFrame | RunFrame | PromptFrame):
+        try:
+            await asyncio.wait_for(_Timed(handler(self._run, event), self.metrics), self._timeout)
+        except asyncio.TimeoutError:
+            self.metrics.timeouts += 1
+            self.metrics.lastError = TimeoutError(f"handler timed out after {self._timeout}s")
+        except Exception as e:
+            self.metrics.errors += 1
+            self.metrics.lastError = e
+
+
+class _Timed:
+    """
+    Await a coroutine, adding the CPU time of each of its steps to metrics.cpuTime. Timing the await itself would also
+    count the other tasks that run while the coroutine is suspended.
+    """
+    __slots__ = ("_coro", "_metrics")
+
+    def __init__(self, coro: Awaitable[Any], metrics: HandlerMetrics):
+        self._coro = coro
+        self._metrics = metrics
+
+    def __await__(self):
+        coro, metrics = self._coro.__await__(), self._metrics
+        value, error = None, None
+        while True:
+            start = time.thread_time()
+            try:
+                future = coro.send(value) if error is None else coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                metrics.cpuTime += time.thread_time() - start
+
+            try:
+                value, error = (yield future), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
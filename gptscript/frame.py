@@ -1,6 +1,7 @@
 from enum import Enum
-from typing import Any
+from typing import Any, Callable, Self
 
+from gptscript.compact import Compact
 from gptscript.tool import Tool, ToolReference
 
 
@@ -33,6 +34,8 @@ class RunState(Enum):
     Continue = "continue",
     Finished = "finished",
     Error = "error"
+    # The run was aborted because it hit one of its timeouts.
+    Timeout = "timeout"
 
     def is_terminal(self):
         return self.value == RunState.Error or self.value == RunState.Finished
@@ -56,7 +59,9 @@ class Program:
                     self.toolSet[tool] = Tool(**self.toolSet[tool])
 
 
-class RunFrame:
+class RunFrame(Compact):
+    __slots__ = ("id", "type", "program", "input", "output", "error", "start", "end", "_state", "chatState")
+
     def __init__(self,
                  id: str = "",
                  type: RunEventType = RunEventType.runStart,
@@ -86,7 +91,9 @@ class RunFrame:
         self.chatState = chatState
 
 
-class Call:
+class Call(Compact):
+    __slots__ = ("toolID", "input")
+
     def __init__(self,
                  toolID: str = "",
                  input: str = "",
@@ -96,7 +103,9 @@ class Call:
         self.input = input
 
 
-class Output:
+class Output(Compact):
+    __slots__ = ("content", "subCalls")
+
     def __init__(self,
                  content: str = "",
                  subCalls: dict[str, Call] = None,
@@ -106,7 +115,9 @@ class Output:
         self.subCalls = subCalls
 
 
-class InputContext:
+class InputContext(Compact):
+    __slots__ = ("toolID", "content")
+
     def __init__(self,
                  toolID: str = "",
                  content: str = "",
@@ -116,7 +127,9 @@ class InputContext:
         self.content = content
 
 
-class Usage:
+class Usage(Compact):
+    __slots__ = ("promptTokens", "completionTokens", "totalTokens")
+
     def __init__(self,
                  promptTokens: int = 0,
                  completionTokens: int = 0,
@@ -128,7 +141,13 @@ class Usage:
         self.totalTokens = totalTokens
 
 
-class CallFrame:
+class CallFrame(Compact):
+    __slots__ = (
+        "id", "tool", "agentGroup", "currentAgent", "displayText", "inputContext", "toolCategory", "toolName",
+        "parentID", "type", "start", "end", "input", "output", "error", "usage", "chatResponseCached", "toolResults",
+        "llmRequest", "llmResponse",
+    )
+
     def __init__(self,
                  id: str = "",
                  tool: Tool = None,
@@ -193,8 +212,165 @@ class CallFrame:
         self.llmRequest = llmRequest
         self.llmResponse = llmResponse
 
+    def modelName(self) -> str:
+        """Return the model of the called tool, or "" if this frame doesn't include the tool."""
+        if isinstance(self.tool, dict):
+            return self.tool.get("modelName", "")
+        return getattr(self.tool, "modelName", "")
+
+
+class CallSummary(Compact):
+    __slots__ = ("id", "parentID", "toolName", "start", "end", "usage")
+
+    def __init__(self,
+                 id: str = "",
+                 parentID: str = "",
+                 toolName: str = "",
+                 start: str = "",
+                 end: str = "",
+                 usage: Usage = None,
+                 **kwargs,
+                 ):
+        self.id = id
+        self.parentID = parentID
+        self.toolName = toolName
+        self.start = start
+        self.end = end
+        self.usage = usage
+        if isinstance(self.usage, dict):
+            self.usage = Usage(**self.usage)
+
+    @classmethod
+    def from_frame(cls, frame: CallFrame) -> Self:
+        return cls(frame.id, frame.parentID, frame.toolName, frame.start, frame.end, frame.usage)
+
+
+class _lazy:
+    """
+    A field of LazyCallFrame that is built by the decorated method when it is first read, and then kept in the slot of
+    the same name in CallFrame.
+    """
+
+    def __init__(self, build: Callable[[Any], Any]):
+        self._build = build
+
+    def __set_name__(self, owner: type, name: str):
+        self._slot = getattr(CallFrame, name)
+
+    def __get__(self, instance: Any, owner: type = None) -> Any:
+        if instance is None:
+            return self
+        try:
+            return self._slot.__get__(instance, owner)
+        except AttributeError:
+            value = self._build(instance)
+            self._slot.__set__(instance, value)
+            return value
+
+    def __set__(self, instance: Any, value: Any):
+        self._slot.__set__(instance, value)
+
+
+class LazyCallFrame(CallFrame):
+    """
+    A CallFrame that keeps the decoded event and only builds the nested objects (agent group, input context, output
+    and usage) when they are first accessed, storing them in the slots of CallFrame. As in CallFrame, the tool is left
+    as it was decoded. __dict__ and vars() build every field.
+    """
+    __slots__ = ("_raw",)
+
+    def __init__(self,
+                 id: str = "",
+                 displayText: str = "",
+                 toolCategory: ToolCategory = ToolCategory.none,
+                 toolName: str = "",
+                 parentID: str = "",
+                 type: RunEventType = RunEventType.event,
+                 start: str = "",
+                 end: str = "",
+                 input: str = "",
+                 error: str = "",
+                 chatResponseCached: bool = False,
+                 toolResults: int = 0,
+                 **kwargs,
+                 ):
+        self.id = id
+        self.displayText = displayText
+        self.toolCategory = toolCategory
+        if isinstance(self.toolCategory, str):
+            self.toolCategory = ToolCategory.none if self.toolCategory == "" else ToolCategory[self.toolCategory]
+        self.toolName = toolName
+        self.parentID = parentID
+        self.type = type
+        if isinstance(self.type, str):
+            self.type = RunEventType[self.type]
+        self.start = start
+        self.end = end
+        self.input = input
+        self.error = error
+        self.chatResponseCached = chatResponseCached
+        self.toolResults = toolResults
+        self._raw = kwargs
+
+    @_lazy
+    def tool(self) -> dict[str, Any] | None:
+        return self._raw.pop("tool", None)
+
+    def modelName(self) -> str:
+        # Read the model from the decoded event, so attributing usage doesn't move the tool into its slot.
+        if "tool" in self._raw:
+            tool = self._raw["tool"]
+            return tool.get("modelName", "") if isinstance(tool, dict) else ""
+        return super().modelName()
+
+    @_lazy
+    def agentGroup(self) -> list[ToolReference] | None:
+        return _build_list(self._raw.pop("agentGroup", None), ToolReference)
+
+    @_lazy
+    def currentAgent(self) -> ToolReference | None:
+        return _build(self._raw.pop("currentAgent", None), ToolReference)
+
+    @_lazy
+    def inputContext(self) -> list[InputContext] | None:
+        return _build_list(self._raw.pop("inputContext", None), InputContext)
+
+    @_lazy
+    def output(self) -> list[Output] | None:
+        return _build_list(self._raw.pop("output", None), Output)
+
+    @_lazy
+    def usage(self) -> Usage | None:
+        return _build(self._raw.pop("usage", None), Usage)
+
+    @_lazy
+    def llmRequest(self) -> Any:
+        return self._raw.pop("llmRequest", None)
+
+    @_lazy
+    def llmResponse(self) -> Any:
+        return self._raw.pop("llmResponse", None)
+
+    @property
+    def __dict__(self) -> dict[str, Any]:
+        fields = self._asdict()
+        fields.pop("_raw", None)
+        return fields
+
+
+def _build(value: Any, cls: type) -> Any:
+    return cls(**value) if isinstance(value, dict) else value
+
+
+def _build_list(values: list | None, cls: type) -> list | None:
+    if values is None:
+        return None
+    return [_build(value, cls) for value in values]
+
+
+class PromptField(Compact):
+    __slots__ = ("name", "description", "sensitive")
 
-class PromptField:
     def __init__(self,
                  name: str = "",
                  description: str = "",
@@ -206,7 +382,9 @@ class PromptField:
         self.sensitive = sensitive
 
 
-class PromptFrame:
+class PromptFrame(Compact):
+    __slots__ = ("id", "time", "message", "fields", "metadata", "sensitive", "type")
+
     def __init__(self,
                  id: str = "",
                  type: RunEventType = RunEventType.prompt,
@@ -1,35 +1,64 @@
+from __future__ import annotations
+
+import asyncio
 import base64
+import copy
 import json
+import math
 import os
-import platform
-from subprocess import Popen, PIPE
-from sys import executable
-from typing import Any, Callable, Awaitable, List
+import threading
+import time
+import weakref
+from typing import Any, Callable, Awaitable, List, Iterable, AsyncIterable, AsyncIterator, TYPE_CHECKING
+
+import httpx
 
+from gptscript.batch import BatchResult, batch
+from gptscript.cache import LoadCache, RefreshCache, ResultCache, load_key, result_key
 from gptscript.confirm import AuthResponse
 from gptscript.credentials import Credential, to_credential
-from gptscript.datasets import DatasetElementMeta, DatasetElement, DatasetMeta
-from gptscript.fileinfo import FileInfo
 from gptscript.frame import RunFrame, CallFrame, PromptFrame, Program
-from gptscript.openai import Model
-from gptscript.opts import GlobalOptions
+from gptscript.opts import GlobalOptions, merge_env
 from gptscript.prompt import PromptResponse
 from gptscript.run import Run, RunBasicCommand, Options
+from gptscript.server import SDKServer, ServerMetrics, ServerPool
+from gptscript.shared import SharedServers, supports_shared_servers
 from gptscript.text import Text
 from gptscript.tool import ToolDef, Tool
+from gptscript.transport import is_unix_url, new_client
+from gptscript.usage import UsageLedger
+
+if TYPE_CHECKING:
+    # These are pydantic models, which are slow to import, so they are only imported by the methods that use them.
+    from gptscript.datasets import DatasetElementMeta, DatasetElement, DatasetMeta
+    from gptscript.fileinfo import FileInfo
+    from gptscript.openai import Model
 
 
 class GPTScript:
     __gptscript_count = 0
     __server_url = ""
-    __process: Popen = None
+    __pool: ServerPool = None
+    __starting: asyncio.Task = None
+    __shared: SharedServers = None
+    __takeover: threading.Thread = None
 
     def __init__(self, opts: GlobalOptions = None):
         if opts is None:
             opts = GlobalOptions()
         self.opts = opts
-
-        start_sdk = GPTScript.__process is None and GPTScript.__server_url == "" and self.opts.URL == ""
+        # Connections in an httpx pool are bound to the event loop that opened them, so each loop has its own clients.
+        self._clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, httpx.AsyncClient]] = \
+            weakref.WeakKeyDictionary()
+        self._clients_lock = threading.Lock()
+        self._closing: set[asyncio.Task] = set()
+        self._result_cache: ResultCache | None = None
+        self._load_cache: LoadCache | None = None
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._model_cache: RefreshCache | None = None
+        self._credential_cache: RefreshCache | None = None
+
+        start_sdk = GPTScript.__pool is None and GPTScript.__server_url == "" and self.opts.URL == ""
         GPTScript.__gptscript_count += 1
         if GPTScript.__server_url == "":
             GPTScript.__server_url = os.environ.get("GPTSCRIPT_URL", "")
@@ -38,38 +67,223 @@ class GPTScript:
         if start_sdk:
             self.opts.toEnv()
 
-            GPTScript.__process = Popen(
-                [_get_command(), "sys.sdkserver", "--listen-address", "127.0.0.1:0"],
-                stdin=PIPE,
-                stdout=PIPE,
-                stderr=PIPE,
-                env={e.split("=", 1)[0]: e.split("=", 1)[1] for e in self.opts.Env},
-                text=True,
-                encoding="utf-8",
-            )
-
-            GPTScript.__server_url = GPTScript.__process.stderr.readline().strip("\n")
-            if "=" in GPTScript.__server_url:
-                GPTScript.__server_url = GPTScript.__server_url.split("=")[1]
+            GPTScript.__pool, GPTScript.__shared = _start_servers(self.opts)
+            GPTScript.__server_url = GPTScript.__pool.servers[0].url
 
         if self.opts.URL == "":
             self.opts.URL = GPTScript.__server_url
-        if not (self.opts.URL.startswith("http://") or self.opts.URL.startswith("https://")):
+        if not (self.opts.URL.startswith("http://") or self.opts.URL.startswith("https://") or is_unix_url(
+                self.opts.URL)):
             self.opts.URL = f"http://{self.opts.URL}"
 
+        # Only route requests through the pool if this instance is talking to the SDK servers started by this module.
+        self._pool: ServerPool | None = None
+        if GPTScript.__pool is not None and self.opts.URL == GPTScript.__server_url:
+            self._pool = GPTScript.__pool
+
         self.opts.Env.append("GPTSCRIPT_URL=" + self.opts.URL)
 
         if self.opts.Token == "":
             self.opts.Token = os.environ.get("GPTSCRIPT_TOKEN", "")
         if self.opts.Token != "":
             self.opts.Env.append("GPTSCRIPT_TOKEN=" + self.opts.Token)
+        self.opts.Env = merge_env(self.opts.Env)
+
+    @classmethod
+    async def create(cls, opts: GlobalOptions = None) -> GPTScript:
+        """
+        Create a GPTScript instance without blocking the event loop while the SDK servers start. The servers are polled
+        until they respond, for up to StartTimeout seconds.
+        """
+        if opts is None:
+            opts = GlobalOptions()
+
+        await cls.prewarm(opts)
+        gptscript = cls(opts)
+        # Open a connection to the server so that the first request doesn't have to.
+        await gptscript.version()
+        return gptscript
+
+    @classmethod
+    def prewarm(cls, opts: GlobalOptions = None) -> asyncio.Task:
+        """
+        Start the SDK servers in the background and return a task that finishes once they respond. Instances that are
+        created after that use them without waiting. Nothing is started if the servers are already running or if an
+        existing server is configured with the URL option or the GPTSCRIPT_URL environment variable.
+        """
+        starting = GPTScript.__starting
+        if starting is None or starting.done() or starting.get_loop() is not asyncio.get_running_loop():
+            starting = asyncio.create_task(cls._prewarm(opts if opts is not None else GlobalOptions()))
+            GPTScript.__starting = starting
+        return starting
+
+    @classmethod
+    async def _prewarm(cls, opts: GlobalOptions):
+        if GPTScript.__pool is not None or GPTScript.__server_url != "" or opts.URL != "" or \
+                os.environ.get("GPTSCRIPT_URL", "") != "":
+            return
+
+        opts.toEnv()
+        # Starting a server blocks until it prints its address, so it is done on another thread.
+        pool, shared = await asyncio.to_thread(_start_servers, opts)
+        if GPTScript.__pool is not None or GPTScript.__server_url != "":
+            # An instance started its own servers while these were starting.
+            _stop_servers(pool, shared)
+            return
+
+        GPTScript.__pool, GPTScript.__shared = pool, shared
+        GPTScript.__server_url = pool.servers[0].url
+        try:
+            await pool.wait_ready(opts.StartTimeout)
+        except Exception:
+            if GPTScript.__pool is pool and GPTScript.__gptscript_count == 0:
+                _stop_servers(pool, shared)
+                GPTScript.__pool, GPTScript.__shared = None, None
+                GPTScript.__server_url = ""
+            raise
+
+    def _http_client(self, url: str = "") -> httpx.AsyncClient:
+        if url == "":
+            url = self.opts.URL
+
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            for closed in [other for other in self._clients if other.is_closed()]:
+                del self._clients[closed]
+            clients = self._clients.setdefault(loop, {})
+
+        # Clients for TCP servers can talk to any of them, but each Unix domain socket needs its own client.
+        key = url if is_unix_url(url) else ""
+        client = clients.get(key)
+        if client is None or client.is_closed:
+            client = new_client(
+                url,
+                limits=httpx.Limits(
+                    max_connections=self.opts.MaxConnections,
+                    max_keepalive_connections=self.opts.MaxKeepaliveConnections,
+                    keepalive_expiry=self.opts.KeepaliveExpiry,
+                ),
+                timeout=httpx.Timeout(self.opts.RequestTimeout),
+            )
+            clients[key] = client
+        return client
+
+    def _close_clients(self):
+        with self._clients_lock:
+            loops = list(self._clients.items())
+            self._clients.clear()
+
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+
+        for loop, clients in loops:
+            if loop.is_closed():
+                continue
+            for client in clients.values():
+                if client.is_closed:
+                    continue
+                if loop is current:
+                    self._schedule_close(loop, client)
+                elif loop.is_running():
+                    # The clients' loop runs in another thread, so they are closed there.
+                    loop.call_soon_threadsafe(self._schedule_close, loop, client)
+                elif current is None:
+                    loop.run_until_complete(client.aclose())
+                # Otherwise another loop is running in this thread, which can't drive the stopped loop of the clients.
+                # Their connections belong to that loop, so they are dropped and closed with it.
+
+    def _schedule_close(self, loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient):
+        task = loop.create_task(client.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    def _on_restart(pool: ServerPool):
+        # Called on the supervisor thread after it restarted servers, whose URLs change unless they use a Unix socket.
+        if pool is not GPTScript.__pool:
+            return
+        GPTScript.__server_url = pool.servers[0].url
+        if GPTScript.__shared is not None:
+            GPTScript.__shared.update(pool)
+
+    @staticmethod
+    def _take_over(shared: SharedServers, interval: float):
+        pool = shared.attach()
+        if GPTScript.__shared is not shared:
+            # The last instance was closed while the servers were starting.
+            _stop_servers(pool, shared)
+            return
+        pool.supervise(interval, GPTScript._on_restart)
+        GPTScript.__pool = pool
+        GPTScript.__server_url = pool.servers[0].url
+
+    def _server(self) -> SDKServer | None:
+        if self._pool is None:
+            return None
+
+        shared = GPTScript.__shared
+        if shared is not None:
+            if not shared.owner_alive():
+                # The servers exited with the process that owned them, so attach to a new owner or become one. That can
+                # start servers, which blocks, so it is done on another thread while requests to the old servers fail
+                # and basic commands are retried.
+                takeover = GPTScript.__takeover
+                if takeover is None or not takeover.is_alive():
+                    GPTScript.__takeover = threading.Thread(
+                        target=GPTScript._take_over,
+                        args=(shared, self.opts.SupervisorInterval),
+                        name="gptscript-takeover",
+                        daemon=True,
+                    )
+                    GPTScript.__takeover.start()
+            elif shared.owner != os.getpid():
+                # The owner records the new URLs of the servers it restarts in the runtime file.
+                pool = shared.refresh(GPTScript.__pool)
+                if pool is not None:
+                    GPTScript.__pool = pool
+                    GPTScript.__server_url = pool.servers[0].url
+            if self._pool is not GPTScript.__pool:
+                self._pool = GPTScript.__pool
+
+        server = self._pool.pick()
+        if self._pool is GPTScript.__pool and self.opts.URL != GPTScript.__server_url:
+            # Tools call back into the SDK server through GPTSCRIPT_URL, so it follows the first server across restarts.
+            self.opts.URL = GPTScript.__server_url
+            self.opts.Env = merge_env(self.opts.Env, ["GPTSCRIPT_URL=" + self.opts.URL])
+        return server
+
+    async def check_health(self) -> int:
+        """Check the SDK servers started by this module, restarting any that are unresponsive. Returns the number
+        of servers that were restarted."""
+        if self._pool is None:
+            return 0
+
+        restarted = await self._pool.check_health()
+        if restarted:
+            GPTScript._on_restart(self._pool)
+        return len(restarted)
+
+    def usage_ledger(self) -> UsageLedger | None:
+        """Return the ledger that the token usage of the runs of this instance is recorded in, or None if the
+        UsageLedger option isn't set."""
+        return self.opts.UsageLedger
+
+    def server_metrics(self) -> ServerMetrics | None:
+        """Return the crash, restart and retry counts of the SDK servers started by this module, or None if this
+        instance doesn't use them."""
+        return self._pool.metrics if self._pool is not None else None
 
     def close(self):
+        self._close_clients()
+        if self._load_cache is not None:
+            self._load_cache.close()
         GPTScript.__gptscript_count -= 1
-        if GPTScript.__gptscript_count == 0 and GPTScript.__process is not None:
-            GPTScript.__process.stdin.close()
-            GPTScript.__process.wait()
-            GPTScript.__process = None
+        if GPTScript.__gptscript_count == 0 and GPTScript.__pool is not None:
+            _stop_servers(GPTScript.__pool, GPTScript.__shared)
+            GPTScript.__pool, GPTScript.__shared = None, None
+            GPTScript.__server_url = ""
             self.opts = None
 
     def evaluate(
@@ -79,12 +293,15 @@ class GPTScript:
             event_handlers: list[Callable[[Run, CallFrame | RunFrame | PromptFrame], Awaitable[None]]] = None
     ) -> Run:
         opts = opts if opts is not None else Options()
-        return Run(
+        server = self._server()
+        return self._start(Run(
             "evaluate",
             tool,
             opts.merge_global_opts(self.opts),
             event_handlers=event_handlers,
-        ).next_chat(opts.input)
+            client=self._http_client(server.url if server is not None else ""),
+            server=server,
+        ), opts.input)
 
     def run(
             self, tool_path: str,
@@ -92,52 +309,150 @@ class GPTScript:
             event_handlers: list[Callable[[Run, CallFrame | RunFrame | PromptFrame], Awaitable[None]]] = None
     ) -> Run:
         opts = opts if opts is not None else Options()
-        return Run(
+        server = self._server()
+        return self._start(Run(
             "run",
             tool_path,
             opts.merge_global_opts(self.opts),
             event_handlers=event_handlers,
-        ).next_chat(opts.input)
+            client=self._http_client(server.url if server is not None else ""),
+            server=server,
+        ), opts.input)
+
+    def result_cache(self) -> ResultCache:
+        """Return the cache of the results of runs with the resultCache option, creating it if needed."""
+        if self._result_cache is None:
+            self._result_cache = ResultCache(
+                max_bytes=self.opts.ResultCacheSize,
+                ttl=self.opts.ResultCacheTTL,
+                directory=self.opts.ResultCacheDir,
+                max_disk_bytes=self.opts.ResultCacheDiskSize,
+            )
+        return self._result_cache
+
+    def _start(self, run: Run, input: str) -> Run:
+        if not run.opts.resultCache:
+            return run.next_chat(input)
+
+        cache = self.result_cache()
+        run.opts.input = input
+        key = result_key(run.requestPath, run.tools, run.opts)
+        result = cache.get(key)
+        if result is not None:
+            return run._complete(result)
+
+        run = run.next_chat(input)
+
+        def store(task: asyncio.Task):
+            # Only successful runs are cached.
+            if not task.cancelled() and task.exception() is None and run.err() == "":
+                cache.put(key, run._result(), background=True)
+
+        run._task.add_done_callback(store)
+        return run
+
+    def evaluate_batch(
+            self,
+            tool: ToolDef | list[ToolDef],
+            inputs: Iterable[str] | AsyncIterable[str],
+            opts: Options = None,
+            event_handlers: list[Callable[[Run, CallFrame | RunFrame | PromptFrame], Awaitable[None]]] = None,
+            concurrency: int = 10,
+            ordered: bool = False,
+    ) -> AsyncIterator[BatchResult]:
+        opts = opts if opts is not None else Options()
+        return batch(
+            lambda input: self.evaluate(tool, _with_input(opts, input), event_handlers),
+            inputs,
+            concurrency=concurrency,
+            ordered=ordered,
+        )
+
+    def run_batch(
+            self,
+            tool_path: str,
+            inputs: Iterable[str] | AsyncIterable[str],
+            opts: Options = None,
+            event_handlers: list[Callable[[Run, CallFrame | RunFrame | PromptFrame], Awaitable[None]]] = None,
+            concurrency: int = 10,
+            ordered: bool = False,
+    ) -> AsyncIterator[BatchResult]:
+        opts = opts if opts is not None else Options()
+        return batch(
+            lambda input: self.run(tool_path, _with_input(opts, input), event_handlers),
+            inputs,
+            concurrency=concurrency,
+            ordered=ordered,
+        )
 
     async def load_file(self, file_path: str, disable_cache: bool = False, sub_tool: str = '') -> Program:
-        out = await self._run_basic_command(
-            "load",
-            {"file": file_path, "disableCache": disable_cache, "subTool": sub_tool},
+        # Only local files are cached here, because remote ones can't be checked for changes.
+        return await self._load(
+            {"file": file_path, "subTool": sub_tool, "disableCache": disable_cache},
+            disable_cache or not os.path.isfile(file_path),
+            [file_path],
         )
-        parsed_nodes = json.loads(out)
-        return Program(**parsed_nodes.get("program", {}))
 
     async def load_content(self, content: str, disable_cache: bool = False, sub_tool: str = '') -> Program:
-        out = await self._run_basic_command(
-            "load",
-            {"content": content, "disableCache": disable_cache, "subTool": sub_tool},
-        )
-        parsed_nodes = json.loads(out)
-        return Program(**parsed_nodes.get("program", {}))
+        return await self._load({"content": content, "subTool": sub_tool, "disableCache": disable_cache},
+                                disable_cache, [])
 
     async def load_tools(self, tool_defs: list[ToolDef], disable_cache: bool = False, sub_tool: str = '') -> Program:
-        out = await self._run_basic_command(
-            "load",
-            {"toolDefs": [t.to_json() for t in tool_defs], "disableCache": disable_cache, "subTool": sub_tool},
+        return await self._load(
+            {"toolDefs": [t.to_json() for t in tool_defs], "subTool": sub_tool, "disableCache": disable_cache},
+            disable_cache,
+            [],
         )
-        parsed_nodes = json.loads(out)
-        return Program(**parsed_nodes.get("program", {}))
 
     async def parse(self, file_path: str, disable_cache: bool = False) -> list[Text | Tool]:
-        out = await self._run_basic_command("parse", {"file": file_path, "disableCache": disable_cache})
+        return await self._parse(
+            {"file": file_path, "disableCache": disable_cache},
+            disable_cache or not os.path.isfile(file_path),
+            [file_path],
+        )
+
+    async def parse_content(self, content: str, disable_cache: bool = False) -> list[Text | Tool]:
+        return await self._parse({"content": content}, disable_cache, [])
+
+    def load_cache(self) -> LoadCache:
+        """Return the cache of the responses to load_file, load_content, load_tools, parse and parse_content. Each
+        call builds new objects from the cached response, so callers can modify what they are returned."""
+        if self._load_cache is None:
+            self._load_cache = LoadCache(max_entries=self.opts.LoadCacheSize, watch=self.opts.LoadCacheWatch)
+        return self._load_cache
+
+    async def _load(self, request_body: dict[str, Any], skip_cache: bool, files: list[str]) -> Program:
+        key = load_key("load", request_body)
+        cache = self.load_cache() if not skip_cache and self.opts.LoadCacheSize > 0 else None
+        out = cache.get(key) if cache is not None else None
+        cached = out is not None
+        if not cached:
+            out = await self._run_basic_command("load", request_body)
+
         parsed_nodes = json.loads(out)
-        if parsed_nodes is None or parsed_nodes.get("nodes", None) is None:
-            return []
-        return [Text(**node["textNode"]) if "textNode" in node else Tool(**node.get("toolNode", {}).get("tool", {})) for
-                node in parsed_nodes.get("nodes", [])]
+        program = Program(**parsed_nodes.get("program", {}))
+        if cache is not None and not cached:
+            # A program also depends on the local files its tools were loaded from.
+            cache.put(key, out, files + [
+                tool.source.location for tool in program.toolSet.values()
+                if tool.source is not None and os.path.isfile(tool.source.location)
+            ])
+        return program
+
+    async def _parse(self, request_body: dict[str, Any], skip_cache: bool, files: list[str]) -> list[Text | Tool]:
+        key = load_key("parse", request_body)
+        cache = self.load_cache() if not skip_cache and self.opts.LoadCacheSize > 0 else None
+        out = cache.get(key) if cache is not None else None
+        if out is None:
+            out = await self._run_basic_command("parse", request_body)
+            if cache is not None:
+                cache.put(key, out, files)
 
-    async def parse_content(self, content: str) -> list[Text | Tool]:
-        out = await self._run_basic_command("parse", {"content": content})
         parsed_nodes = json.loads(out)
         if parsed_nodes is None or parsed_nodes.get("nodes", None) is None:
             return []
-        return [Text(**node["textNode"]) if "textNode" in node else Tool(**node.get("toolNode", {}).get("tool", {})) for
-                node in parsed_nodes.get("nodes", [])]
+        return [Text(**node["textNode"]) if "textNode" in node else Tool(**node.get("toolNode", {}).get("tool", {}))
+                for node in parsed_nodes.get("nodes", [])]
 
     async def fmt(self, nodes: list[Text | Tool]) -> str:
         request_nodes = []
@@ -146,13 +461,61 @@ class GPTScript:
         return await self._run_basic_command("fmt", {"nodes": request_nodes})
 
     async def confirm(self, resp: AuthResponse):
-        await self._run_basic_command("confirm/" + resp.id, {**vars(resp)})
+        await self._run_basic_command("confirm/" + resp.id, {**vars(resp)}, route=resp.id)
 
     async def prompt(self, resp: PromptResponse):
-        await self._run_basic_command("prompt-response/" + resp.id, resp.responses)
-
-    async def _run_basic_command(self, sub_command: str, request_body: Any = None):
-        run = RunBasicCommand(sub_command, request_body, self.opts.URL, self.opts.Token)
+        await self._run_basic_command("prompt-response/" + resp.id, resp.responses, route=resp.id)
+
+    async def _run_basic_command(self, sub_command: str, request_body: Any = None, route: str = ""):
+        if sub_command not in self.opts.CoalescedCommands:
+            return await self._send_basic_command(sub_command, request_body, route)
+
+        key = sub_command + ":" + json.dumps(request_body, sort_keys=True, default=str)
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.create_task(self._send_basic_command(sub_command, request_body, route))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key) if self._inflight.get(key) is t else None)
+
+        # Shielded so that a caller that is cancelled doesn't cancel the request for the other callers.
+        return await asyncio.shield(task)
+
+    async def _send_basic_command(self, sub_command: str, request_body: Any = None, route: str = ""):
+        retries = self.opts.CommandRetries if self._pool is not None and sub_command in self.opts.RetriedCommands else 0
+        for attempt in range(retries + 1):
+            try:
+                return await self._send_basic_command_once(sub_command, request_body, route)
+            except Exception as e:
+                # Only requests that failed because the connection to the server was lost are sent again.
+                if attempt == retries or not isinstance(e.__cause__, (httpx.NetworkError, httpx.RemoteProtocolError)):
+                    raise
+
+            self._pool.metrics.retries += 1
+            # Wait for the crashed server to be restarted, without blocking the event loop. Servers owned by another
+            # process are restarted by it, so the retry waits for it to record their new URLs, which _server() reads.
+            managed = [server for server in self._pool.servers if server.managed()]
+            restarts = self._pool.metrics.restarts
+            recovered = await asyncio.gather(*[asyncio.to_thread(self._pool.recover, server) for server in managed])
+            if self._pool.metrics.restarts != restarts:
+                GPTScript._on_restart(self._pool)
+            if not managed or not all(recovered):
+                await asyncio.sleep(self.opts.RestartBackoff * 2 ** attempt)
+
+    async def _send_basic_command_once(self, sub_command: str, request_body: Any = None, route: str = ""):
+        # Responses to confirm and prompt events must go to the server that is running the call waiting on them.
+        server = None
+        if self._pool is not None:
+            server = self._pool.route(route) if route != "" else self._server()
+
+        run = RunBasicCommand(
+            sub_command,
+            request_body,
+            server.url if server is not None else self.opts.URL,
+            self.opts.Token,
+            client=self._http_client(server.url if server is not None else ""),
+            server=server,
+            global_opts=self.opts,
+        )
 
         run.next_chat()
 
@@ -171,52 +534,112 @@ class GPTScript:
                 providers = []
             providers.append(self.opts.DefaultModelProvider)
 
-        res = await self._run_basic_command(
-            "list-models",
-            {"providers": providers, "credentialOverrides": credential_overrides}
+        request_body = {"providers": providers, "credentialOverrides": credential_overrides}
+        if self.opts.ModelCacheTTL <= 0:
+            return await self._list_models(request_body)
+
+        models = await self.model_cache().get(
+            json.dumps(request_body, sort_keys=True),
+            lambda: self._list_models(request_body),
         )
+        return list(models)
+
+    def model_cache(self) -> RefreshCache:
+        """Return the cache of the results of list_models. Results older than ModelCacheTTL are returned while they are
+        refreshed in the background."""
+        if self._model_cache is None:
+            self._model_cache = RefreshCache(lambda _: (time.time() + self.opts.ModelCacheTTL, math.inf))
+        return self._model_cache
+
+    async def _list_models(self, request_body: dict[str, Any]) -> list[Model]:
+        from gptscript.openai import Model
+
+        res = await self._run_basic_command("list-models", request_body)
         return [Model(**model) for model in json.loads(res)]
 
     async def list_credentials(self, contexts: List[str] = None, all_contexts: bool = False) -> list[Credential] | str:
         if contexts is None:
             contexts = ["default"]
 
-        res = await self._run_basic_command(
+        res = await self._credentials(
             "credentials",
-            {"context": contexts, "allContexts": all_contexts}
+            {"context": contexts, "allContexts": all_contexts},
+            lambda out: [to_credential(cred) for cred in json.loads(out)],
         )
-        if res.startswith("an error occurred:"):
-            return res
-
-        return [to_credential(cred) for cred in json.loads(res)]
+        return list(res) if isinstance(res, list) else res
 
     async def create_credential(self, cred: Credential) -> str:
-        return await self._run_basic_command(
+        res = await self._run_basic_command(
             "credentials/create",
             {"content": cred.to_json()}
         )
+        self._invalidate_credentials(cred.context, cred.toolName)
+        return res
 
     async def reveal_credential(self, contexts: List[str] = None, name: str = "") -> Credential | str:
         if contexts is None:
             contexts = ["default"]
 
-        res = await self._run_basic_command(
+        return await self._credentials(
             "credentials/reveal",
-            {"context": contexts, "name": name}
+            {"context": contexts, "name": name},
+            lambda out: to_credential(json.loads(out)),
         )
-        if res.startswith("an error occurred:"):
-            return res
-
-        return to_credential(json.loads(res))
 
     async def delete_credential(self, context: str = "default", name: str = "") -> str:
-        return await self._run_basic_command(
+        res = await self._run_basic_command(
             "credentials/delete",
             {"context": [context], "name": name}
         )
+        self._invalidate_credentials(context, name)
+        return res
+
+    def credential_cache(self) -> RefreshCache:
+        """Return the in-memory cache of the results of list_credentials and reveal_credential."""
+        if self._credential_cache is None:
+            self._credential_cache = RefreshCache(self._credential_expiry)
+        return self._credential_cache
+
+    async def _credentials(self, sub_command: str, request_body: dict[str, Any], parse: Callable[[str], Any]) -> Any:
+        async def fetch() -> Any:
+            out = await self._run_basic_command(sub_command, request_body)
+            if out.startswith("an error occurred:"):
+                return out
+            return parse(out)
+
+        if self.opts.CredentialCacheTTL <= 0:
+            return await fetch()
+        return await self.credential_cache().get(sub_command + ":" + json.dumps(request_body, sort_keys=True), fetch)
+
+    def _credential_expiry(self, value: Credential | list[Credential] | str) -> tuple[float, float]:
+        if isinstance(value, str):
+            # Errors are not cached.
+            return 0, 0
+
+        expires_at = math.inf
+        for cred in value if isinstance(value, list) else [value]:
+            if cred.expiresAt is not None:
+                expires_at = min(expires_at, cred.expiresAt.timestamp() - self.opts.CredentialExpiryMargin)
+
+        # Credentials that are about to expire are refreshed early enough for the new ones to arrive before they do.
+        refresh_at = min(time.time() + self.opts.CredentialCacheTTL, expires_at - self.opts.CredentialExpiryMargin)
+        return refresh_at, expires_at
+
+    def _invalidate_credentials(self, context: str, name: str):
+        if self._credential_cache is None:
+            return
+
+        for key in self._credential_cache.keys():
+            sub_command, request_body = key.split(":", 1)
+            request_body = json.loads(request_body)
+            if (request_body.get("allContexts") or context in request_body["context"]) and \
+                    (sub_command == "credentials" or request_body["name"] == name):
+                self._credential_cache.invalidate(key)
 
     # list_datasets returns an array of dataset IDs
     async def list_datasets(self) -> List[DatasetMeta]:
+        from gptscript.datasets import DatasetMeta
+
         res = await self._run_basic_command(
             "datasets",
             {
@@ -253,6 +676,8 @@ class GPTScript:
         return res
 
     async def list_dataset_elements(self, datasetID: str) -> List[DatasetElementMeta]:
+        from gptscript.datasets import DatasetElementMeta
+
         if datasetID == "":
             raise ValueError("datasetID cannot be empty")
 
@@ -267,6 +692,8 @@ class GPTScript:
         return [DatasetElementMeta.model_validate(d) for d in json.loads(res)]
 
     async def get_dataset_element(self, datasetID: str, elementName: str) -> DatasetElement:
+        from gptscript.datasets import DatasetElement
+
         if datasetID == "":
             raise ValueError("datasetID cannot be empty")
         elif elementName == "":
@@ -381,6 +808,8 @@ class GPTScript:
         ))
 
     async def stat_file_in_workspace(self, file_path: str, workspace_id: str = "") -> FileInfo:
+        from gptscript.fileinfo import FileInfo
+
         if workspace_id == "":
             workspace_id = os.environ["GPTSCRIPT_WORKSPACE_ID"]
 
@@ -395,12 +824,35 @@ class GPTScript:
         ))
 
 
-def _get_command():
-    if os.getenv("GPTSCRIPT_BIN") is not None:
-        return os.getenv("GPTSCRIPT_BIN")
+def _start_servers(opts: GlobalOptions) -> tuple[ServerPool, SharedServers | None]:
+    def start() -> ServerPool:
+        return ServerPool.start(
+            opts.SDKServerWorkers,
+            {e.split("=", 1)[0]: e.split("=", 1)[1] for e in opts.Env},
+            opts.UnixSocket,
+            opts.StartTimeout,
+            opts.RestartBackoff,
+            opts.MaxRestartBackoff,
+        )
+
+    shared = None
+    if opts.SharedServerFile != "" and supports_shared_servers():
+        shared = SharedServers(opts.SharedServerFile, start)
+        pool = shared.attach()
+    else:
+        pool = start()
+    # Servers attached from another process are only supervised by their owner.
+    pool.supervise(opts.SupervisorInterval, GPTScript._on_restart)
+    return pool, shared
+
+
+def _stop_servers(pool: ServerPool, shared: SharedServers | None):
+    # Servers shared with other processes are only stopped by their owner, once every other process has detached.
+    if shared is None or shared.detach():
+        pool.stop()
 
-    bin_path = os.path.join(os.path.dirname(executable), "gptscript")
-    if platform.system() == "Windows":
-        bin_path += ".exe"
 
-    return bin_path if os.path.exists(bin_path) else "gptscript"
+def _with_input(opts: Options, input: str) -> Options:
+    opts = copy.copy(opts)
+    opts.input = input
+    return opts
@@ -1,5 +1,6 @@
 import os
-from typing import Self
+from enum import Enum
+from typing import Any, Callable, Self
 
 
 class GlobalOptions:
@@ -15,6 +16,36 @@ class GlobalOptions:
             datasetTool: str = "",
             workspaceTool: str = "",
             env: list[str] = None,
+            maxConnections: int = 100,
+            maxKeepaliveConnections: int = 20,
+            keepaliveExpiry: float = 30.0,
+            requestTimeout: float = 15 * 60.0,
+            connectTimeout: float = 10.0,
+            firstEventTimeout: float = 0,
+            idleTimeout: float = 0,
+            runTimeout: float = 0,
+            metricsHandler: Callable[[Any, Any], None] = None,
+            tracer: Any = None,
+            usageLedger: Any = None,
+            unixSocket: str = "",
+            sdkServerWorkers: int = 1,
+            startTimeout: float = 30.0,
+            sharedServerFile: str = "",
+            supervisorInterval: float = 1.0,
+            restartBackoff: float = 0.5,
+            maxRestartBackoff: float = 30.0,
+            retriedCommands: list[str] = None,
+            commandRetries: int = 2,
+            resultCacheSize: int = 64 * 1024 * 1024,
+            resultCacheTTL: float = 60 * 60.0,
+            resultCacheDir: str = "",
+            resultCacheDiskSize: int = 1024 * 1024 * 1024,
+            loadCacheSize: int = 128,
+            loadCacheWatch: bool = False,
+            coalescedCommands: list[str] = None,
+            modelCacheTTL: float = 0,
+            credentialCacheTTL: float = 0,
+            credentialExpiryMargin: float = 60.0,
     ):
         self.URL = url
         self.Token = token
@@ -30,9 +61,55 @@ class GlobalOptions:
         elif isinstance(env, dict):
             env = [f"{k}={v}" for k, v in env.items()]
         self.Env = env
+        self.MaxConnections = maxConnections
+        self.MaxKeepaliveConnections = maxKeepaliveConnections
+        self.KeepaliveExpiry = keepaliveExpiry
+        self.RequestTimeout = requestTimeout
+        # The default timeouts of runs and sub-commands, in seconds, or 0 for no limit. See Options.
+        self.ConnectTimeout = connectTimeout
+        self.FirstEventTimeout = firstEventTimeout
+        self.IdleTimeout = idleTimeout
+        self.RunTimeout = runTimeout
+        # Called with each run and its RunMetrics when the run's request finishes.
+        self.MetricsHandler = metricsHandler
+        # A gptscript.tracing.Tracer that records a span for each run and each of its calls.
+        self.Tracer = tracer
+        # A gptscript.usage.UsageLedger that the token usage of each run is recorded in. Instances that should share
+        # totals are given the same ledger.
+        self.UsageLedger = usageLedger
+        self.UnixSocket = unixSocket
+        self.SDKServerWorkers = sdkServerWorkers
+        self.StartTimeout = startTimeout
+        self.SharedServerFile = sharedServerFile
+        self.SupervisorInterval = supervisorInterval
+        self.RestartBackoff = restartBackoff
+        self.MaxRestartBackoff = maxRestartBackoff
+        # These sub-commands are sent again if the server handling them crashes, because they don't change anything.
+        if retriedCommands is None:
+            retriedCommands = [
+                "version", "list-models", "load", "parse", "fmt", "credentials", "credentials/reveal", "datasets",
+                "datasets/list-elements", "datasets/get-element", "workspaces/list", "workspaces/read-file",
+                "workspaces/stat-file",
+            ]
+        self.RetriedCommands = retriedCommands
+        self.CommandRetries = commandRetries
+        self.ResultCacheSize = resultCacheSize
+        self.ResultCacheTTL = resultCacheTTL
+        # The directory of the on-disk tier of the result cache. Results are only cached in memory if this is empty.
+        self.ResultCacheDir = resultCacheDir
+        self.ResultCacheDiskSize = resultCacheDiskSize
+        self.LoadCacheSize = loadCacheSize
+        self.LoadCacheWatch = loadCacheWatch
+        # Concurrent calls of these sub-commands with the same request body share a single request.
+        if coalescedCommands is None:
+            coalescedCommands = ["version", "list-models", "load", "parse", "fmt", "credentials", "credentials/reveal"]
+        self.CoalescedCommands = coalescedCommands
+        self.ModelCacheTTL = modelCacheTTL
+        self.CredentialCacheTTL = credentialCacheTTL
+        self.CredentialExpiryMargin = credentialExpiryMargin
 
     def merge(self, other: Self) -> Self:
-        cp = self.__class__()
+        cp = self.__class__(env=[])
         if other is None:
             return self
         cp.URL = other.URL if other.URL != "" else self.URL
@@ -44,8 +121,11 @@ class GlobalOptions:
         cp.CacheDir = other.CacheDir if other.CacheDir != "" else self.CacheDir
         cp.DatasetTool = other.DatasetTool if other.DatasetTool != "" else self.DatasetTool
         cp.WorkspaceTool = other.WorkspaceTool if other.WorkspaceTool != "" else self.WorkspaceTool
-        cp.Env = (other.Env or [])
-        cp.Env.extend(self.Env or [])
+        cp.MetricsHandler = other.MetricsHandler if other.MetricsHandler is not None else self.MetricsHandler
+        cp.Tracer = other.Tracer if other.Tracer is not None else self.Tracer
+        cp.UsageLedger = other.UsageLedger if other.UsageLedger is not None else self.UsageLedger
+        # Variables set in both are only sent once, with the value from these options.
+        cp.Env = merge_env(other.Env, self.Env)
         return cp
 
     def toEnv(self):
@@ -62,6 +142,44 @@ class GlobalOptions:
             self.Env.append(f"GPTSCRIPT_SDKSERVER_DEFAULT_MODEL_PROVIDER={self.DefaultModelProvider}")
 
 
+# The options that the SDK server reads from a run request. The others only configure this module.
+_REQUEST_FIELDS = (
+    "APIKey", "BaseURL", "DefaultModel", "DefaultModelProvider", "CacheDir", "DatasetTool", "WorkspaceTool", "Env",
+    "input", "disableCache", "subTool", "workspace", "chatState", "confirm", "prompt", "credentialOverrides",
+    "credentialContexts", "location", "forceSequential",
+)
+
+
+def merge_env(*envs: list[str] | None) -> list[str]:
+    """
+    Merge lists of KEY=VALUE environment variables into a new list. A variable that is set more than once keeps the
+    position of its first occurrence and the value of its last.
+    """
+    merged = {}
+    for env in envs:
+        for e in env or []:
+            merged[e.split("=", 1)[0]] = e
+    return list(merged.values())
+
+
+class CallRetention(Enum):
+    # Keep the latest frame of every call for the life of the run.
+    all = "all"
+    # Keep the latest frame of calls that are in flight and of the most recently finished calls.
+    recent = "recent"
+    # Keep only a CallSummary of every call.
+    summary = "summary"
+
+
+class EventOverflow(Enum):
+    # Stop reading events from the server until the consumer catches up.
+    block = "block"
+    # Drop the oldest queued event to make room for the new one.
+    dropOldest = "dropOldest"
+    # Drop the new event.
+    dropNewest = "dropNewest"
+
+
 class Options(GlobalOptions):
     def __init__(self,
                  input: str = "",
@@ -85,6 +203,20 @@ class Options(GlobalOptions):
                  cacheDir: str = "",
                  datasetToolDir: str = "",
                  workspaceTool: str = "",
+                 lazyFrames: bool = False,
+                 dropLLMPayloads: bool = False,
+                 callRetention: CallRetention | str = CallRetention.all,
+                 finishedCallsLimit: int = 100,
+                 eventQueueSize: int = 1000,
+                 eventOverflow: EventOverflow | str = EventOverflow.block,
+                 handlerConcurrency: int = 10,
+                 handlerTimeout: float = 0,
+                 handlerQueueSize: int = 1000,
+                 resultCache: bool = False,
+                 connectTimeout: float = None,
+                 firstEventTimeout: float = None,
+                 idleTimeout: float = None,
+                 runTimeout: float = None,
                  ):
         super().__init__(url, token, apiKey, baseURL, defaultModelProvider, defaultModel, cacheDir, datasetToolDir,
                          workspaceTool, env)
@@ -99,6 +231,30 @@ class Options(GlobalOptions):
         self.credentialContexts = credentialContexts
         self.location = location
         self.forceSequential = forceSequential
+        self.lazyFrames = lazyFrames
+        self.dropLLMPayloads = dropLLMPayloads
+        # Stored as a string so that the options can still be serialized.
+        self.callRetention = CallRetention(callRetention).value
+        self.finishedCallsLimit = finishedCallsLimit
+        self.eventQueueSize = eventQueueSize
+        self.eventOverflow = EventOverflow(eventOverflow).value
+        self.handlerConcurrency = handlerConcurrency
+        self.handlerTimeout = handlerTimeout
+        self.handlerQueueSize = handlerQueueSize
+        self.resultCache = resultCache
+        # The number of seconds to wait for a connection to the server, for the first event, between events and for the
+        # whole run, or 0 for no limit. The global options are used for the ones that are None.
+        self.connectTimeout = connectTimeout
+        self.firstEventTimeout = firstEventTimeout
+        self.idleTimeout = idleTimeout
+        self.runTimeout = runTimeout
+
+    def toRequest(self) -> dict[str, Any]:
+        """
+        Return the options to send with a run request: only the ones the SDK server reads, and only if they are set,
+        because the server treats missing options as empty.
+        """
+        return {name: getattr(self, name) for name in _REQUEST_FIELDS if getattr(self, name)}
 
     def merge_global_opts(self, other: GlobalOptions) -> Self:
         cp = super().merge(other)
@@ -115,4 +271,30 @@ class Options(GlobalOptions):
         cp.credentialContexts = self.credentialContexts
         cp.location = self.location
         cp.forceSequential = self.forceSequential
-        return cp
+        cp.lazyFrames = self.lazyFrames
+        cp.dropLLMPayloads = self.dropLLMPayloads
+        cp.callRetention = self.callRetention
+        cp.finishedCallsLimit = self.finishedCallsLimit
+        cp.eventQueueSize = self.eventQueueSize
+        cp.eventOverflow = self.eventOverflow
+        cp.handlerConcurrency = self.handlerConcurrency
+        cp.handlerTimeout = self.handlerTimeout
+        cp.handlerQueueSize = self.handlerQueueSize
+        cp.resultCache = self.resultCache
+        cp.connectTimeout = self.connectTimeout
+        cp.firstEventTimeout = self.firstEventTimeout
+        cp.idleTimeout = self.idleTimeout
+        cp.runTimeout = self.runTimeout
+        return cp.merge_timeouts(other)
+
+    def merge_timeouts(self, other: GlobalOptions) -> Self:
+        """Use the timeouts of the global options for the ones that are not set in these options."""
+        if self.connectTimeout is None:
+            self.connectTimeout = other.ConnectTimeout
+        if self.firstEventTimeout is None:
+            self.firstEventTimeout = other.FirstEventTimeout
+        if self.idleTimeout is None:
+            self.idleTimeout = other.IdleTimeout
+        if self.runTimeout is None:
+            self.runTimeout = other.RunTimeout
+        return self
@@ -1,18 +1,57 @@
 import asyncio
-import sys
 import json
-from typing import Union, Any, Self, Callable, Awaitable
+import math
+import time
+from collections import OrderedDict
+from typing import Union, Any, Self, Callable, Awaitable, AsyncIterator
 
 import httpx
 
-from gptscript.frame import PromptFrame, RunFrame, CallFrame, RunState, RunEventType, Program, ToolCategory
-from gptscript.opts import Options
+from gptscript.compact import Compact
+from gptscript.decoder import EventDecoder, to_frame
+from gptscript.dispatcher import EventDispatcher, HandlerMetrics
+from gptscript.frame import PromptFrame, RunFrame, CallFrame, CallSummary, RunState, RunEventType, Program, ToolCategory
+from gptscript.opts import GlobalOptions, Options, CallRetention, EventOverflow
+from gptscript.server import SDKServer
 from gptscript.tool import ToolDef, Tool
+from gptscript.transport import new_client, http_url
+from gptscript.usage import RunUsage
+
+# Marks the end of the events of a run in its event queue.
+_END_OF_EVENTS = object()
+
+
+class RunMetrics(Compact):
+    __slots__ = (
+        "started", "connectTime", "timeToFirstByte", "timeToFirstProgress", "duration", "events", "bytes",
+        "decodeTime", "handlerTime",
+    )
+
+    def __init__(self):
+        # The times are in seconds. The time to first byte, to first callProgress and the duration are measured from
+        # when the request was started, and are None until they are reached.
+        self.started = time.perf_counter()
+        # The time spent opening a connection to the server, which is 0 if an idle connection was reused.
+        self.connectTime = 0.0
+        # The time until the response headers were received.
+        self.timeToFirstByte: float | None = None
+        self.timeToFirstProgress: float | None = None
+        self.duration: float | None = None
+        self.events: dict[RunEventType, int] = {}
+        self.bytes = 0
+        # The CPU time spent decoding the response into events and running the event handlers.
+        self.decodeTime = 0.0
+        self.handlerTime = 0.0
+
+    def eventRate(self) -> float:
+        """Return the number of events received per second."""
+        return sum(self.events.values()) / self.duration if self.duration else 0.0
 
 
 class Run:
     def __init__(self, subCommand: str, tools: Union[ToolDef | list[ToolDef] | str], opts: Options,
-                 event_handlers: list[Callable[[Self, CallFrame | RunFrame | PromptFrame], Awaitable[None]]] = None):
+                 event_handlers: list[Callable[[Self, CallFrame | RunFrame | PromptFrame], Awaitable[None]]] = None,
+                 client: httpx.AsyncClient | None = None, server: SDKServer | None = None):
         self.requestPath = subCommand
         self.tools = tools
         self.event_handlers = event_handlers
@@ -28,17 +67,40 @@ class Run:
         self._err: str = ""
         self._aborted: bool = False
         self._program: Program | None = None
-        self._calls: dict[str, CallFrame] | None = None
+        self._calls: dict[str, CallFrame | CallSummary] | None = None
+        self._finishedCalls: OrderedDict[str, None] = OrderedDict()
         self._parentCallID: str = ""
         self._rawOutput: Any = None
         self._task: Awaitable | None = None
         self._resp: httpx.Response | None = None
-        self._event_tasks: list[Awaitable[None]] = []
+        self._dispatcher: EventDispatcher | None = None
+        # The client is owned by the GPTScript instance that created this run and is never closed here.
+        self._client = client
+        # Continuations of this run are sent to the same server.
+        self._server = server
+        self._routes: set[str] = set()
+        self._events: asyncio.Queue | None = None
+        self._eventsClosed: bool = False
+        # Fires when the run hits its first event, idle or overall timeout, and is rescheduled as events arrive.
+        self._timer: asyncio.Timeout | None = None
+        self._started: float = 0.0
+        self._received: bool = False
+        self._metrics: RunMetrics | None = None
+        self._trace: Any = None
+        self._usage: RunUsage | None = None
 
     def program(self):
         return self._program
 
-    def calls(self):
+    def calls(self) -> dict[str, CallFrame | CallSummary] | None:
+        """
+        Return the calls of this run keyed by call ID, or None if no call events have been received. What is kept
+        depends on the callRetention option:
+        - all: the latest CallFrame of every call.
+        - recent: the latest CallFrame of every call that is in flight and of the finishedCallsLimit most recently
+          finished calls.
+        - summary: a CallSummary (id, parentID, toolName, start, end and usage) of every call.
+        """
         return self._calls
 
     def parentCallID(self):
@@ -52,13 +114,13 @@ class Run:
             if self._task is not None:
                 await self._task
         except Exception as e:
-            self._state = RunState.Error
-            if self._aborted:
+            self._state = RunState.Timeout if isinstance(e, (TimeoutError, httpx.TimeoutException)) else RunState.Error
+            if self._aborted and self._state != RunState.Timeout:
                 self._err = "Run was aborted"
             else:
                 self._err = str(e)
 
-            raise Exception(self._err)
+            raise Exception(self._err) from e
         finally:
             self._task = None
 
@@ -69,16 +131,82 @@ class Run:
     def err(self):
         return self._err
 
+    def metrics(self) -> RunMetrics | None:
+        """Return the timings and counters of the request of this run, or None if it wasn't sent to the server."""
+        return self._metrics
+
+    def usage(self) -> RunUsage | None:
+        """Return the token usage of the calls of this run so far, or None if it wasn't sent to the server."""
+        return self._usage
+
+    def handlerMetrics(self) -> HandlerMetrics | None:
+        """Return the event handler metrics of this run, or None if no event has been handled."""
+        return self._dispatcher.metrics if self._dispatcher is not None else None
+
+    def events(self) -> AsyncIterator[CallFrame | RunFrame | PromptFrame]:
+        """
+        Return an async iterator over the events of this run. Events are buffered in a queue that holds up to
+        eventQueueSize events. When the queue is full, the eventOverflow option decides whether reading from the server
+        is paused until the consumer catches up (block), or whether the oldest or the newest event is dropped.
+
+        This should be called right after the run is created, before anything is awaited, or earlier events are missed.
+        """
+        if self._events is None:
+            # Unless the run blocks on a full queue, one more slot is kept for the end of the events, so that no event
+            # is dropped to make room for it.
+            size = self.opts.eventQueueSize
+            if size > 0 and EventOverflow(self.opts.eventOverflow) != EventOverflow.block:
+                size += 1
+            self._events = asyncio.Queue(maxsize=size)
+            if self._eventsClosed:
+                self._events.put_nowait(_END_OF_EVENTS)
+        return self._iter_events(self._events)
+
+    async def _iter_events(self, queue: asyncio.Queue) -> AsyncIterator[CallFrame | RunFrame | PromptFrame]:
+        try:
+            while True:
+                event = await queue.get()
+                if event is _END_OF_EVENTS:
+                    return
+                yield event
+        finally:
+            if self._events is queue:
+                self._events = None
+            # Unblock the run if it is waiting for space in the queue.
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def _publish(self, event: Any):
+        queue = self._events
+        if queue is None:
+            return
+
+        overflow = EventOverflow(self.opts.eventOverflow)
+        if overflow == EventOverflow.block:
+            await queue.put(event)
+            return
+
+        if event is not _END_OF_EVENTS and 0 < self.opts.eventQueueSize <= queue.qsize():
+            if overflow == EventOverflow.dropNewest:
+                return
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    async def _close_events(self):
+        self._eventsClosed = True
+        await self._publish(_END_OF_EVENTS)
+
     def state(self):
         return self._state
 
     def next_chat(self, input: str = "") -> Self:
-        if self._state != RunState.Continue and self._state != RunState.Creating and self._state != RunState.Error:
-            raise Exception(f"Run must in creating, continue or error state, not {self._state}")
+        if self._state not in (RunState.Continue, RunState.Creating, RunState.Error, RunState.Timeout):
+            raise Exception(f"Run must in creating, continue, error or timeout state, not {self._state}")
 
         run = self
         if run.state != RunState.Creating:
-            run = type(self)(self.requestPath, self.tools, self.opts, event_handlers=self.event_handlers)
+            run = type(self)(self.requestPath, self.tools, self.opts, event_handlers=self.event_handlers,
+                             client=self._client, server=self._server)
 
         if self.chatState and self._state == RunState.Continue:
             # Only update the chat state if the previous run didn't error.
@@ -86,119 +214,312 @@ class Run:
             run.opts.chatState = self.chatState
 
         run.opts.input = input
-        if isinstance(run.tools, list):
-            run._task = asyncio.create_task(
-                run._request({
-                    "toolDefs": [
-                        tool.to_json().get("toolNode", {}).get("tool", {}) if isinstance(tool, Tool) else tool.to_json()
-                        for tool in run.tools
-                    ], **vars(run.opts)
-                })
-            )
-        elif isinstance(run.tools, str) and run.tools != "":
-            run._task = asyncio.create_task(run._request({"file": run.tools, **vars(run.opts)}))
-        elif isinstance(run.tools, ToolDef) or isinstance(run.tools, Tool):
+        run._acquire_server()
+        run._metrics = RunMetrics()
+        run._usage = RunUsage()
+        run._task = asyncio.create_task(run._request(run._request_body()))
+
+        return run
+
+    def _request_body(self) -> dict[str, Any]:
+        if isinstance(self.tools, list):
+            return {
+                "toolDefs": [
+                    tool.to_json().get("toolNode", {}).get("tool", {}) if isinstance(tool, Tool) else tool.to_json()
+                    for tool in self.tools
+                ], **self.opts.toRequest()
+            }
+        elif isinstance(self.tools, str) and self.tools != "":
+            return {"file": self.tools, **self.opts.toRequest()}
+        elif isinstance(self.tools, ToolDef) or isinstance(self.tools, Tool):
             # In this last case, this.tools is a single ToolDef.
-            run._task = asyncio.create_task(run._request({
+            return {
                 "toolDefs": [
-                    run.tools.to_json().get("toolNode", {}).get("tool", {})
-                    if isinstance(run.tools, Tool) else run.tools.to_json()
+                    self.tools.to_json().get("toolNode", {}).get("tool", {})
+                    if isinstance(self.tools, Tool) else self.tools.to_json()
                 ],
-                **vars(run.opts)
-            }))
-        else:
-            run._task = asyncio.create_task(run._request({**vars(run.opts)}))
-
-        return run
+                **self.opts.toRequest()
+            }
+        return {**self.opts.toRequest()}
 
     async def _request(self, tool: Any):
-        if self._state.is_terminal():
-            raise Exception("run is in terminal state and cannot be run again: state " + str(self._state))
-
-        # Use a timeout of 15 minutes = 15 * 60s.
-        async with httpx.AsyncClient(timeout=httpx.Timeout(15 * 60.0)) as client:
-            method = "GET" if tool is None else "POST"
-
-            headers = None
-            if self.opts.Token:
-                headers = {"Authorization": f"Bearer {self.opts.Token}"}
-
-            async with client.stream(
-                    method,
-                    self.opts.URL + "/" + self.requestPath,
-                    json=tool,
-                    headers=headers,
-            ) as resp:
-                self._resp = resp
-                self._state = RunState.Running
-                done = True
-                if resp.status_code < 200 or resp.status_code >= 400:
-                    self._state = RunState.Error
-                    self._err = "run encountered an error"
-
-                async for line in resp.aiter_lines():
-                    line = line.strip().removeprefix("data: ").strip()
-                    if line == '' or line == '"[DONE]"':
-                        continue
-
-                    data = json.loads(line)
-
-                    if "stdout" in data:
-                        if isinstance(data["stdout"], str):
-                            self._output = data["stdout"]
-                        else:
-                            if isinstance(self, RunBasicCommand):
-                                self._output = json.dumps(data["stdout"])
-                            else:
-                                self.chatState = json.dumps(data["stdout"]["state"])
-                                if "content" in data["stdout"]:
-                                    self._output = data["stdout"]["content"]
-
-                                done = data["stdout"].get("done", False)
-                                self._rawOutput = data["stdout"]
-                    elif "stderr" in data:
-                        self._errput += data["stderr"]
+        try:
+            if self._state.is_terminal():
+                raise Exception("run is in terminal state and cannot be run again: state " + str(self._state))
+
+            if self.opts.Tracer is not None:
+                self._trace = self.opts.Tracer.trace(
+                    "gptscript." + self.requestPath,
+                    {"gptscript.tool": self.tools} if isinstance(self.tools, str) and self.tools else None,
+                )
+            try:
+                async with asyncio.timeout(None) as self._timer:
+                    self._started = asyncio.get_running_loop().time()
+                    self._reschedule()
+                    if self._client is not None:
+                        done = await self._stream(self._client, tool)
                     else:
-                        if "prompt" in data:
-                            event = PromptFrame(**data["prompt"])
-
-                            # If a prmpt happens, but the call didn't explicitly allow it, then we error.
-                            if not self.opts.prompt:
-                                self._err = f"prompt event occurred when prompt was not allowed: {event.__dict__}"
-                                await self.aclose()
-                                break
-                        elif "run" in data:
-                            event = RunFrame(**data["run"])
-                            if event.type == RunEventType.runStart:
-                                self._program = event.program
-                            elif event.type == RunEventType.runFinish and event.error != "":
-                                self._err = event.error
-                        else:
-                            event = CallFrame(**data["call"])
-                            if self._calls is None:
-                                self._calls = {}
-                            self._calls[event.id] = event
-                            if event.parentID == "" and self._parentCallID == "" and event.toolCategory != ToolCategory.none:
-                                self._parentCallID = event.id
-                        if self.event_handlers is not None:
-                            for event_handler in self.event_handlers:
-                                self._event_tasks.append(asyncio.create_task(event_handler(self, event)))
-
-        self._resp = None
-        if self._err != "":
-            self._state = RunState.Error
-        elif done:
-            self._state = RunState.Finished
-        else:
-            self._state = RunState.Continue
+                        async with new_client(self._url()) as client:
+                            done = await self._stream(client, tool)
+            except TimeoutError:
+                # The stream was closed when the timer cancelled it, which ends the run like aclose does.
+                if self._timer.expired():
+                    raise TimeoutError(self._timeout_reason()) from None
+                raise
+            finally:
+                self._timer = None
+
+            self._resp = None
+            if self._err != "":
+                self._state = RunState.Error
+            elif done:
+                self._state = RunState.Finished
+            else:
+                self._state = RunState.Continue
+        except BaseException as e:
+            self._finish_metrics()
+            self._finish_trace(str(e) or type(e).__name__)
+            raise
+        finally:
+            self._release_server()
+            self._finish_usage()
+            await self._close_events()
+        self._finish_trace(self._err)
+
+        if self._dispatcher is not None:
+            await self._dispatcher.wait()
+        self._finish_metrics()
+
+    async def _dispatch(self, event: CallFrame | RunFrame | PromptFrame):
+        if self._dispatcher is None:
+            self._dispatcher = EventDispatcher(
+                self,
+                self.event_handlers,
+                concurrency=self.opts.handlerConcurrency,
+                timeout=self.opts.handlerTimeout,
+                max_pending=self.opts.handlerQueueSize,
+            )
+        await self._dispatcher.dispatch(event)
+
+    def _retain_call(self, event: CallFrame):
+        if self._calls is None:
+            self._calls = {}
+
+        retention = CallRetention(self.opts.callRetention)
+        if retention == CallRetention.summary:
+            self._calls[event.id] = CallSummary.from_frame(event)
+            return
+
+        self._calls[event.id] = event
+        if retention == CallRetention.recent and event.type == RunEventType.callFinish:
+            self._finishedCalls[event.id] = None
+            self._finishedCalls.move_to_end(event.id)
+            while len(self._finishedCalls) > self.opts.finishedCallsLimit:
+                call_id, _ = self._finishedCalls.popitem(last=False)
+                self._calls.pop(call_id, None)
+
+    def _result(self) -> dict[str, Any]:
+        return {
+            "output": self._output,
+            "errput": self._errput,
+            "chatState": self.chatState,
+            "rawOutput": self._rawOutput,
+            "state": self._state.name,
+        }
+
+    def _complete(self, result: dict[str, Any]) -> Self:
+        # Complete this run with a cached result instead of sending it to the server. No events are received.
+        self._output = result["output"]
+        self._errput = result["errput"]
+        self.chatState = result["chatState"]
+        self._rawOutput = result["rawOutput"]
+        self._state = RunState[result["state"]]
+        self._eventsClosed = True
+        return self
+
+    def _finish_metrics(self):
+        metrics = self._metrics
+        if metrics is None or metrics.duration is not None:
+            return
 
-        for task in self._event_tasks:
+        metrics.duration = time.perf_counter() - metrics.started
+        if self._dispatcher is not None:
+            metrics.handlerTime = self._dispatcher.metrics.cpuTime
+        if self.opts.MetricsHandler is not None:
             try:
-                await task
+                self.opts.MetricsHandler(self, metrics)
             except Exception as e:
-                print(f"error during event processing: {e}")
+                print(f"error in metrics handler: {e}")
+
+    def _finish_usage(self):
+        if self._usage is None:
+            return
+
+        self._usage.finish()
+        if self.opts.UsageLedger is not None:
+            self.opts.UsageLedger.record(self._usage, ",".join(self.opts.credentialContexts or ["default"]))
+
+    def _finish_trace(self, error: str):
+        if self._trace is not None:
+            self._trace.finish(error)
+            self._trace = None
+
+    def _reschedule(self, idle: bool = True):
+        # The timer is set to the earliest of the overall deadline and either the first event or the idle timeout. While
+        # the run waits for its consumers (idle=False), only the overall deadline applies.
+        when = None
+        if self.opts.runTimeout:
+            when = self._started + self.opts.runTimeout
+        if not self._received and self.opts.firstEventTimeout:
+            when = min(when or math.inf, self._started + self.opts.firstEventTimeout)
+        elif self._received and self.opts.idleTimeout and idle:
+            when = min(when or math.inf, asyncio.get_running_loop().time() + self.opts.idleTimeout)
+        self._timer.reschedule(when)
+
+    def _timeout_reason(self) -> str:
+        now = asyncio.get_running_loop().time()
+        if self.opts.runTimeout and now >= self._started + self.opts.runTimeout:
+            return f"run timed out after {self.opts.runTimeout}s"
+        if not self._received:
+            return f"run timed out waiting {self.opts.firstEventTimeout}s for its first event"
+        return f"run timed out after {self.opts.idleTimeout}s without an event"
+
+    def _url(self) -> str:
+        # The server's URL changes if it is restarted, so it is preferred over the URL in the options.
+        return self._server.url if self._server is not None else self.opts.URL
+
+    def _acquire_server(self):
+        if self._server is not None:
+            self._server.outstanding += 1
+
+    def _release_server(self):
+        if self._server is not None:
+            self._server.outstanding -= 1
+            self._server.routes.difference_update(self._routes)
+            self._routes.clear()
+
+    def _route(self, id: str):
+        if self._server is not None:
+            self._server.routes.add(id)
+            self._routes.add(id)
+
+    async def _stream(self, client: httpx.AsyncClient, tool: Any) -> bool:
+        method = "GET" if tool is None else "POST"
+
+        headers = None
+        if self.opts.Token:
+            headers = {"Authorization": f"Bearer {self.opts.Token}"}
+
+        timeout = client.timeout
+        if self.opts.connectTimeout is not None:
+            timeout = httpx.Timeout(
+                connect=self.opts.connectTimeout or None, read=timeout.read, write=timeout.write, pool=timeout.pool,
+            )
 
-        self._event_tasks = []
+        metrics = self._metrics
+        if metrics is None:
+            metrics = self._metrics = RunMetrics()
+        connecting = 0.0
+
+        async def trace(name: str, _: dict[str, Any]):
+            nonlocal connecting
+            if name.startswith("connection.connect_"):
+                if name.endswith(".started"):
+                    connecting = time.perf_counter()
+                elif name.endswith(".complete"):
+                    metrics.connectTime += time.perf_counter() - connecting
+
+        async with client.stream(
+                method,
+                http_url(self._url()) + "/" + self.requestPath,
+                json=tool,
+                headers=headers,
+                timeout=timeout,
+                extensions={"trace": trace},
+        ) as resp:
+            metrics.timeToFirstByte = time.perf_counter() - metrics.started
+            self._resp = resp
+            self._state = RunState.Running
+            done = True
+            if resp.status_code < 200 or resp.status_code >= 400:
+                self._state = RunState.Error
+                self._err = "run encountered an error"
+
+            async for data in self._decode_events(resp):
+                if not self._received or self.opts.idleTimeout:
+                    self._received = True
+                    self._reschedule()
+                if "stdout" in data:
+                    if isinstance(data["stdout"], str):
+                        self._output = data["stdout"]
+                    else:
+                        if isinstance(self, RunBasicCommand):
+                            self._output = json.dumps(data["stdout"])
+                        else:
+                            self.chatState = json.dumps(data["stdout"]["state"])
+                            if "content" in data["stdout"]:
+                                self._output = data["stdout"]["content"]
+
+                            done = data["stdout"].get("done", False)
+                            self._rawOutput = data["stdout"]
+                elif "stderr" in data:
+                    self._errput += data["stderr"]
+                else:
+                    start = time.thread_time()
+                    event = to_frame(data, self.opts.lazyFrames, self.opts.dropLLMPayloads)
+                    metrics.decodeTime += time.thread_time() - start
+                    metrics.events[event.type] = metrics.events.get(event.type, 0) + 1
+                    if event.type == RunEventType.callProgress and metrics.timeToFirstProgress is None:
+                        metrics.timeToFirstProgress = time.perf_counter() - metrics.started
+
+                    if isinstance(event, PromptFrame):
+                        self._route(event.id)
+
+                        # If a prmpt happens, but the call didn't explicitly allow it, then we error.
+                        if not self.opts.prompt:
+                            self._err = f"prompt event occurred when prompt was not allowed: {event.__dict__}"
+                            await self.aclose()
+                            break
+                    elif isinstance(event, RunFrame):
+                        if event.type == RunEventType.runStart:
+                            self._program = event.program
+                            if self._usage is not None:
+                                self._usage.runID = event.id
+                        elif event.type == RunEventType.runFinish and event.error != "":
+                            self._err = event.error
+                    else:
+                        if event.type == RunEventType.callConfirm:
+                            self._route(event.id)
+                        if self._trace is not None:
+                            self._trace.on_call(event)
+                        if self._usage is not None:
+                            self._usage.on_call(event)
+                        self._retain_call(event)
+                        if event.parentID == "" and self._parentCallID == "" and event.toolCategory != ToolCategory.none:
+                            self._parentCallID = event.id
+                    # Time spent waiting for a slow consumer or handler isn't time without an event from the server.
+                    if self.opts.idleTimeout:
+                        self._reschedule(idle=False)
+                    await self._publish(event)
+                    if self.event_handlers:
+                        await self._dispatch(event)
+                    if self.opts.idleTimeout:
+                        self._reschedule()
+
+        return done
+
+    async def _decode_events(self, resp: httpx.Response):
+        decoder = EventDecoder()
+        metrics = self._metrics
+        async for chunk in resp.aiter_bytes():
+            metrics.bytes += len(chunk)
+            start = time.thread_time()
+            events = decoder.feed(chunk)
+            metrics.decodeTime += time.thread_time() - start
+            for data in events:
+                yield data
+        for data in decoder.flush():
+            yield data
 
     async def aclose(self):
         if self._task is None or self._resp is None:
@@ -209,8 +530,13 @@ class Run:
 
 
 class RunBasicCommand(Run):
-    def __init__(self, subCommand: str, request_body: Any, gptscriptURL: str, gptscriptToken: str):
-        super().__init__(subCommand, "", Options(url=gptscriptURL, token=gptscriptToken))
+    def __init__(self, subCommand: str, request_body: Any, gptscriptURL: str, gptscriptToken: str,
+                 client: httpx.AsyncClient | None = None, server: SDKServer | None = None,
+                 global_opts: GlobalOptions | None = None):
+        opts = Options(url=gptscriptURL, token=gptscriptToken)
+        if global_opts is not None:
+            opts.merge_timeouts(global_opts)
+        super().__init__(subCommand, "", opts, client=client, server=server)
         self.request_body = request_body
 
     def next_chat(self, input: str = "") -> Self:
@@ -218,6 +544,8 @@ class RunBasicCommand(Run):
             raise Exception(f"A basic command run must in creating, not {self._state}")
 
         self.opts.input = input
+        self._acquire_server()
+        self._metrics = RunMetrics()
         self._task = self._request(self.request_body)
 
         return self
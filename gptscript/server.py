@@ -0,0 +1,385 @@
+import asyncio
+import os
+import platform
+import socket
+import threading
+import time
+from subprocess import Popen, PIPE
+from sys import executable
+from typing import Callable, Self
+
+import httpx
+
+from gptscript.compact import Compact
+from gptscript.transport import UNIX_SCHEME, is_unix_url, http_url, new_client, supports_unix_sockets
+
+
+class SDKServer:
+    def __init__(self,
+                 url: str,
+                 process: Popen = None,
+                 listen_address: str = "",
+                 env: dict[str, str] = None,
+                 timeout: float = None,
+                 ):
+        self.url = url
+        self.process = process
+        self.listen_address = listen_address
+        self.env = env
+        # The number of seconds to wait for the server to report its address when it is started.
+        self.timeout = timeout
+        # The number of requests that have been routed to this server and haven't finished.
+        self.outstanding = 0
+        self.restarts = 0
+        self.started = time.monotonic()
+        # Held while the server is restarted or stopped, which can happen on the supervisor thread.
+        self.lock = threading.Lock()
+        # Whether the exit of the current process has been counted as a crash, the number of crashes and failed
+        # restarts in a row, and when the server may next be restarted.
+        self.crashed = False
+        self.failures = 0
+        self.retryAt = 0.0
+        # The IDs of confirm and prompt events that this server is waiting on a response for.
+        self.routes: set[str] = set()
+        # The device and inode of the Unix domain socket that this server created, so that stop only removes that file.
+        self.socket: tuple[int, int] | None = None
+
+    @classmethod
+    def start(cls, env: dict[str, str], unix_socket: str = "", timeout: float = None) -> Self:
+        if unix_socket != "" and supports_unix_sockets() and _remove_stale_socket(unix_socket):
+            listen_address = UNIX_SCHEME + unix_socket
+            process, url = _start_sdkserver(listen_address, env, timeout)
+            if url == listen_address:
+                server = cls(url, process, listen_address, env, timeout)
+                server.socket = _socket_id(unix_socket)
+                return server
+
+            # This gptscript binary can't listen on a Unix domain socket, so fall back to TCP.
+            process.kill()
+            process.wait()
+
+        process, url = _start_sdkserver("127.0.0.1:0", env, timeout)
+        return cls(url, process, "127.0.0.1:0", env, timeout)
+
+    async def wait_ready(self, timeout: float = 30.0, interval: float = 0.05):
+        """Poll the server until it responds, raising a TimeoutError if it doesn't within timeout seconds."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with new_client(self.url, timeout=httpx.Timeout(timeout)) as client:
+            while True:
+                try:
+                    resp = await client.get(http_url(self.url) + "/version")
+                    if 200 <= resp.status_code < 400:
+                        return
+                except httpx.HTTPError:
+                    pass
+
+                if not self.alive():
+                    raise Exception(f"the SDK server at {self.url} exited before it was ready")
+                if loop.time() >= deadline:
+                    raise TimeoutError(f"the SDK server at {self.url} was not ready after {timeout}s")
+                await asyncio.sleep(interval)
+
+    def managed(self) -> bool:
+        return self.process is not None
+
+    def alive(self) -> bool:
+        return self.process is None or self.process.poll() is None
+
+    def restart(self):
+        if not self.managed():
+            return
+
+        self.stop()
+        if is_unix_url(self.listen_address) and not _remove_stale_socket(self.listen_address.removeprefix(UNIX_SCHEME)):
+            raise Exception(f"another process is listening on {self.listen_address}")
+        self.process, self.url = _start_sdkserver(self.listen_address, self.env, self.timeout)
+        if is_unix_url(self.listen_address):
+            self.socket = _socket_id(self.listen_address.removeprefix(UNIX_SCHEME))
+        self.started = time.monotonic()
+        self.restarts += 1
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        # Another process may have created a socket at the same path since, which is left alone.
+        path = self.listen_address.removeprefix(UNIX_SCHEME)
+        if self.socket is not None and _socket_id(path) == self.socket:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.socket = None
+
+
+class ServerMetrics(Compact):
+    __slots__ = ("crashes", "restarts", "failedRestarts", "retries", "totalRestartTime", "maxRestartTime")
+
+    def __init__(self):
+        # The number of times a server process exited without being stopped.
+        self.crashes = 0
+        self.restarts = 0
+        self.failedRestarts = 0
+        # The number of requests that were sent again after the server handling them crashed.
+        self.retries = 0
+        # The time, in seconds, it took to start a server again.
+        self.totalRestartTime = 0.0
+        self.maxRestartTime = 0.0
+
+    def avgRestartTime(self) -> float:
+        return self.totalRestartTime / self.restarts if self.restarts else 0.0
+
+
+# A server that crashes within this many seconds of starting is restarted with a growing delay.
+_MIN_UPTIME = 10.0
+
+
+class ServerPool:
+    def __init__(self, servers: list[SDKServer], backoff: float = 0.5, max_backoff: float = 30.0):
+        if not servers:
+            raise ValueError("servers cannot be empty")
+
+        self.servers = servers
+        self.metrics = ServerMetrics()
+        self._next = 0
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._stopped = threading.Event()
+        self._supervisor: threading.Thread | None = None
+        self._on_restart: Callable[[Self], None] | None = None
+
+    @classmethod
+    def start(cls, size: int, env: dict[str, str], unix_socket: str = "", timeout: float = None,
+              backoff: float = 0.5, max_backoff: float = 30.0) -> Self:
+        servers = []
+        try:
+            for i in range(max(size, 1)):
+                servers.append(SDKServer.start(env, _socket_path(unix_socket, i), timeout))
+        except Exception:
+            for server in servers:
+                server.stop()
+            raise
+
+        return cls(servers, backoff, max_backoff)
+
+    def pick(self) -> SDKServer:
+        """
+        Return the live server with the fewest outstanding requests. Ties are broken round-robin so that a burst of new
+        requests is spread across the pool. Servers whose process has exited are skipped while they are restarted, by
+        the supervisor if the pool is supervised, or otherwise on a thread started here, because restarting blocks until
+        the new process reports its address.
+        """
+        if self._supervisor is None:
+            for server in self.servers:
+                if server.managed() and not server.alive() and not server.lock.locked():
+                    threading.Thread(target=self._recover, args=(server,), name="gptscript-restart", daemon=True).start()
+
+        start = self._next
+        self._next = (self._next + 1) % len(self.servers)
+        candidates = self.servers[start:] + self.servers[:start]
+        return min(candidates, key=lambda s: (not s.alive(), s.outstanding))
+
+    def recover(self, server: SDKServer) -> bool:
+        """
+        Restart the server if its process has exited, unless it is backing off after crashing shortly after it started
+        or failing to restart. Returns whether the server is alive.
+        """
+        with server.lock:
+            if server.alive():
+                return True
+            if self._stopped.is_set():
+                return False
+
+            now = time.monotonic()
+            if not server.crashed:
+                server.crashed = True
+                self.metrics.crashes += 1
+                server.failures = server.failures + 1 if now - server.started < _MIN_UPTIME else 0
+                server.retryAt = now + self._delay(server.failures)
+            if now < server.retryAt:
+                return False
+
+            if not self._restart(server):
+                server.failures += 1
+                server.retryAt = time.monotonic() + self._delay(server.failures)
+                return False
+            server.crashed = False
+            return True
+
+    def _recover(self, server: SDKServer):
+        if self.recover(server) and self._on_restart is not None and not self._stopped.is_set():
+            self._on_restart(self)
+
+    def _restart_unhealthy(self, server: SDKServer) -> bool:
+        with server.lock:
+            if not self._restart(server):
+                return False
+            server.crashed = False
+            return True
+
+    def _restart(self, server: SDKServer) -> bool:
+        # The caller holds the server's lock.
+        start = time.monotonic()
+        try:
+            server.restart()
+        except Exception:
+            self.metrics.failedRestarts += 1
+            return False
+
+        elapsed = time.monotonic() - start
+        self.metrics.restarts += 1
+        self.metrics.totalRestartTime += elapsed
+        self.metrics.maxRestartTime = max(self.metrics.maxRestartTime, elapsed)
+        return True
+
+    def _delay(self, failures: int) -> float:
+        return min(self._backoff * 2 ** (failures - 1), self._max_backoff) if failures > 0 else 0.0
+
+    def supervise(self, interval: float = 1.0, on_restart: Callable[[Self], None] = None):
+        """
+        Watch the servers on a background thread, every interval seconds, and restart the ones whose process has exited
+        without waiting for the next request. on_restart is called on that thread after servers have been restarted, and
+        after pick restarts a server if the pool isn't supervised.
+        """
+        self._on_restart = on_restart
+        if interval <= 0 or self._supervisor is not None or not any(s.managed() for s in self.servers):
+            return
+
+        def watch():
+            while not self._stopped.wait(interval):
+                restarted = False
+                for server in self.servers:
+                    if server.managed() and not server.alive():
+                        restarted = self.recover(server) or restarted
+                if restarted and on_restart is not None and not self._stopped.is_set():
+                    on_restart(self)
+
+        self._supervisor = threading.Thread(target=watch, name="gptscript-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def route(self, id: str) -> SDKServer:
+        """Return the server that is waiting on a response for the confirm or prompt event with the given ID."""
+        for server in self.servers:
+            if id in server.routes:
+                server.routes.discard(id)
+                return server
+
+        return self.pick()
+
+    async def check_health(self, timeout: float = 5.0) -> list[SDKServer]:
+        """Probe every server and restart the ones that are not responding. The restarted servers are returned."""
+        restarted = []
+        for server in self.servers:
+            healthy = server.alive()
+            if healthy:
+                try:
+                    async with new_client(server.url, timeout=httpx.Timeout(timeout)) as client:
+                        resp = await client.get(http_url(server.url) + "/version")
+                        healthy = 200 <= resp.status_code < 400
+                except httpx.HTTPError:
+                    healthy = False
+
+            if not healthy and server.managed() and await asyncio.to_thread(self._restart_unhealthy, server):
+                restarted.append(server)
+
+        return restarted
+
+    async def wait_ready(self, timeout: float = 30.0):
+        await asyncio.gather(*[server.wait_ready(timeout) for server in self.servers])
+
+    def stop(self):
+        self._stopped.set()
+        for server in self.servers:
+            with server.lock:
+                server.stop()
+        if self._supervisor is not None and self._supervisor is not threading.current_thread():
+            self._supervisor.join(timeout=5)
+
+
+def _socket_path(unix_socket: str, i: int) -> str:
+    if unix_socket == "" or i == 0:
+        return unix_socket
+    return f"{unix_socket}.{i}"
+
+
+def _start_sdkserver(listen_address: str, env: dict[str, str], timeout: float = None) -> tuple[Popen, str]:
+    process = Popen(
+        [_get_command(), "sys.sdkserver", "--listen-address", listen_address],
+        stdin=PIPE,
+        stdout=PIPE,
+        stderr=PIPE,
+        env=env,
+        text=True,
+        encoding="utf-8",
+    )
+
+    server_url = _read_address(process, timeout).strip("\n")
+    if "=" in server_url:
+        server_url = server_url.split("=")[1]
+    if not (server_url.startswith("http://") or server_url.startswith("https://") or is_unix_url(server_url)):
+        server_url = f"http://{server_url}"
+
+    return process, server_url
+
+
+def _remove_stale_socket(path: str) -> bool:
+    """
+    Remove a Unix domain socket left behind by a server that exited without removing it. Returns False if a server is
+    still listening on it, or the path can't be removed, in which case it can't be listened on.
+    """
+    if not os.path.exists(path):
+        return True
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return False
+        except OSError:
+            pass
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return False
+    return True
+
+
+def _socket_id(path: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def _read_address(process: Popen, timeout: float = None) -> str:
+    # The server prints its address once it is listening. Reading it blocks, so it is read on another thread if there
+    # is a timeout, and the server is killed if it doesn't print it in time.
+    if timeout is None:
+        return process.stderr.readline()
+
+    lines = []
+    reader = threading.Thread(target=lambda: lines.append(process.stderr.readline()), daemon=True)
+    reader.start()
+    reader.join(timeout)
+    if reader.is_alive():
+        process.kill()
+        process.wait()
+        raise TimeoutError(f"the SDK server did not report its address after {timeout}s")
+    return lines[0]
+
+
+def _get_command():
+    if os.getenv("GPTSCRIPT_BIN") is not None:
+        return os.getenv("GPTSCRIPT_BIN")
+
+    bin_path = os.path.join(os.path.dirname(executable), "gptscript")
+    if platform.system() == "Windows":
+        bin_path += ".exe"
+
+    return bin_path if os.path.exists(bin_path) else "gptscript"
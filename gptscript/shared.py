@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+from gptscript.server import SDKServer, ServerPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def supports_shared_servers() -> bool:
+    return fcntl is not None
+
+
+class SharedServers:
+    """
+    Share the SDK servers started by one process with the other processes that use the same runtime file, such as the
+    workers of a pre-fork server. The file records the process that owns the servers, their URLs and the processes that
+    are attached to them, and is only read or written while holding a lock on path + ".lock". The servers exit with the
+    process that owns them; the next process to attach after that takes over by starting new ones.
+    """
+
+    def __init__(self, path: str, start: Callable[[], ServerPool]):
+        self.path = path
+        self.owner = 0
+        self._start = start
+        # The modification time, size and inode of the runtime file when this process last read or wrote it.
+        self._seen: tuple[int, int, int] | None = None
+
+    def attach(self) -> ServerPool:
+        """Return the servers of the live owner, or start new servers and become their owner."""
+        with self._lock():
+            state = self._read()
+            pid = os.getpid()
+            state["clients"] = [c for c in state.get("clients", []) if c != pid and _alive(c)] + [pid]
+            if _alive(state.get("owner", 0)) and state.get("urls"):
+                pool = ServerPool([SDKServer(url) for url in state["urls"]])
+            else:
+                pool = self._start()
+                state["owner"] = pid
+                state["urls"] = [server.url for server in pool.servers]
+
+            self.owner = state["owner"]
+            self._write(state)
+        return pool
+
+    def detach(self) -> bool:
+        """
+        Detach this process from the servers. Returns True if this process owns them and no other process is attached,
+        in which case the servers should be stopped.
+        """
+        with self._lock():
+            state = self._read()
+            pid = os.getpid()
+            state["clients"] = [c for c in state.get("clients", []) if c != pid and _alive(c)]
+            last = state.get("owner") == pid and not state["clients"]
+            self._write({} if last else state)
+        return last
+
+    def owner_alive(self) -> bool:
+        return _alive(self.owner)
+
+    def refresh(self, pool: ServerPool) -> ServerPool | None:
+        """
+        Return a pool of the servers in the runtime file if another process changed their URLs, for example when the
+        owner restarted one of them, or None if they are the URLs of the given pool. This only stats the file unless it
+        changed since this process last read or wrote it.
+        """
+        if self._stamp() == self._seen:
+            return None
+
+        with self._lock():
+            state = self._read()
+        urls = state.get("urls") or []
+        if state.get("owner") != self.owner or urls == [server.url for server in pool.servers]:
+            return None
+
+        refreshed = ServerPool([SDKServer(url) for url in urls])
+        refreshed.metrics = pool.metrics
+        return refreshed
+
+    def update(self, pool: ServerPool):
+        """Record the URLs of the servers after this process, as their owner, restarted some of them."""
+        with self._lock():
+            state = self._read()
+            if state.get("owner") == os.getpid():
+                state["urls"] = [server.url for server in pool.servers]
+                self._write(state)
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        with open(self.path + ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read(self) -> dict[str, Any]:
+        self._seen = self._stamp()
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, state: dict[str, Any]):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self._seen = self._stamp()
+
+    def _stamp(self) -> tuple[int, int, int] | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _alive(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
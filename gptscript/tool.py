@@ -1,5 +1,7 @@
 from typing import Any
 
+from gptscript.compact import Compact
+
 
 class Property:
     def __init__(self,
@@ -32,14 +34,21 @@ class ArgumentSchema:
         self.required = required
 
     def to_json(self):
-        out = self.__dict__
-        for prop in self.properties:
-            out["properties"][prop] = self.properties[prop].to_json()
+        out = dict(self.__dict__)
+        if self.properties is not None:
+            out["properties"] = {prop: self.properties[prop].to_json() for prop in self.properties}
 
         return out
 
 
-class ToolDef:
+class ToolDef(Compact):
+    __slots__ = (
+        "name", "description", "maxTokens", "modelName", "modelProvider", "jsonResponse", "temperature", "cache",
+        "chat", "internalPrompt", "arguments", "tools", "globalTools", "globalModelName", "context", "exportContext",
+        "export", "agents", "credentials", "exportCredentials", "inputFilters", "exportInputFilters", "outputFilters",
+        "exportOutputFilters", "instructions", "type", "metaData",
+    )
+
     def __init__(self,
                  name: str = "",
                  description: str = "",
@@ -102,13 +111,15 @@ class ToolDef:
         self.metaData = metaData
 
     def to_json(self) -> dict[str, Any]:
-        out = self.__dict__
+        out = self._asdict()
         if self.arguments is not None:
             out["arguments"] = self.arguments.to_json()
         return out
 
 
-class ToolReference:
+class ToolReference(Compact):
+    __slots__ = ("named", "reference", "arg", "toolID")
+
     def __init__(self,
                  named: str = "",
                  reference: str = "",
@@ -122,7 +133,7 @@ class ToolReference:
         self.toolID = toolID
 
     def to_json(self) -> dict[str, Any]:
-        return self.__dict__
+        return self._asdict()
 
 
 class Repo:
@@ -159,6 +170,8 @@ class SourceRef:
 
 
 class Tool(ToolDef):
+    __slots__ = ("id", "toolMapping", "localTools", "source", "workingDir")
+
     def __init__(self,
                  id: str = "",
                  name: str = "",
@@ -220,9 +233,11 @@ class Tool(ToolDef):
         tool_dict["localTools"] = self.localTools
 
         if self.toolMapping is not None:
-            for tool_map in self.toolMapping:
-                for i in range(len(self.toolMapping[tool_map])):
-                    tool_dict["toolMapping"][tool_map][i] = self.toolMapping[tool_map][i].to_json()
+            tool_dict["toolMapping"] = {
+                tool_map: [ref.to_json() if isinstance(ref, ToolReference) else ref for ref in refs]
+                if refs is not None else None
+                for tool_map, refs in self.toolMapping.items()
+            }
 
         if self.source is not None:
             tool_dict["source"] = self.source.to_json()
@@ -0,0 +1,171 @@
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any
+
+from gptscript.compact import Compact
+from gptscript.frame import CallFrame, RunEventType
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class Span(Compact):
+    __slots__ = ("traceId", "spanId", "parentId", "name", "start", "end", "attributes", "error")
+
+    def __init__(self, traceId: str, spanId: str, parentId: str, name: str, start: int,
+                 attributes: dict[str, Any] = None):
+        # The IDs are hex strings, and the times are nanoseconds since the epoch, as in OpenTelemetry.
+        self.traceId = traceId
+        self.spanId = spanId
+        self.parentId = parentId
+        self.name = name
+        self.start = start
+        self.end = 0
+        self.attributes = attributes if attributes is not None else {}
+        self.error = ""
+
+
+class SpanExporter:
+    """Receives spans when they start and when they end. This one discards them."""
+
+    def start(self, span: Span):
+        pass
+
+    def end(self, span: Span):
+        pass
+
+
+class InMemorySpanExporter(SpanExporter):
+    """Keeps the spans that have ended, in the order they ended."""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def end(self, span: Span):
+        self.spans.append(span)
+
+    def clear(self):
+        self.spans = []
+
+
+class OpenTelemetryExporter(SpanExporter):
+    """
+    Record spans with an OpenTelemetry tracer, from the global tracer provider by default. This requires the
+    opentelemetry-api package, and an SDK to be configured for the spans to be exported anywhere.
+    """
+
+    def __init__(self, tracer: Any = None):
+        if otel_trace is None:
+            raise ImportError("the opentelemetry-api package is required to export spans to OpenTelemetry")
+        self._tracer = tracer if tracer is not None else otel_trace.get_tracer("gptscript")
+        self._spans: dict[str, Any] = {}
+
+    def start(self, span: Span):
+        # Spans without a parent here are the spans of runs, which belong to the caller's current span.
+        parent = self._spans.get(span.parentId)
+        self._spans[span.spanId] = self._tracer.start_span(
+            span.name,
+            context=otel_trace.set_span_in_context(parent) if parent is not None else None,
+            start_time=span.start,
+            attributes=span.attributes,
+        )
+
+    def end(self, span: Span):
+        otel_span = self._spans.pop(span.spanId, None)
+        if otel_span is None:
+            return
+
+        otel_span.set_attributes(span.attributes)
+        if span.error:
+            otel_span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=span.end)
+
+
+class Tracer:
+    """
+    Turn runs into traces: each run gets a span, which is a child of the caller's current OpenTelemetry span if there is
+    one, and each call of the run gets a span nested under the span of the call that made it.
+    """
+
+    def __init__(self, exporter: SpanExporter = None):
+        self.exporter = exporter if exporter is not None else SpanExporter()
+
+    def trace(self, name: str, attributes: dict[str, Any] = None) -> "RunTrace":
+        return RunTrace(self.exporter, name, attributes)
+
+
+class RunTrace:
+    """The spans of one run, built from its callStart and callFinish frames."""
+
+    def __init__(self, exporter: SpanExporter, name: str, attributes: dict[str, Any] = None):
+        self._exporter = exporter
+        trace_id, parent_id = _caller()
+        self.root = Span(trace_id, _new_id(8), parent_id, name, time.time_ns(), attributes)
+        # The spans of the calls that have started and not finished, by call ID.
+        self._calls: dict[str, Span] = {}
+        exporter.start(self.root)
+
+    def on_call(self, frame: CallFrame):
+        if frame.type == RunEventType.callStart and frame.id not in self._calls:
+            parent = self._calls.get(frame.parentID, self.root)
+            span = Span(parent.traceId, _new_id(8), parent.spanId, frame.toolName or "call",
+                        _timestamp(frame.start), {"gptscript.call.id": frame.id, "gptscript.tool.name": frame.toolName})
+            model = frame.modelName()
+            if model:
+                span.attributes["gen_ai.request.model"] = model
+            self._calls[frame.id] = span
+            self._exporter.start(span)
+        elif frame.type == RunEventType.callFinish:
+            span = self._calls.pop(frame.id, None)
+            if span is None:
+                return
+
+            span.end = _timestamp(frame.end)
+            span.attributes["gptscript.chat_response_cached"] = frame.chatResponseCached
+            if frame.usage is not None:
+                span.attributes["gen_ai.usage.input_tokens"] = frame.usage.promptTokens
+                span.attributes["gen_ai.usage.output_tokens"] = frame.usage.completionTokens
+                span.attributes["gen_ai.usage.total_tokens"] = frame.usage.totalTokens
+            span.error = frame.error or ""
+            self._exporter.end(span)
+
+    def finish(self, error: str = ""):
+        """End the span of the run, and those of any calls that didn't finish."""
+        now = time.time_ns()
+        for span in reversed(self._calls.values()):
+            span.end = now
+            span.error = "the call did not finish"
+            self._exporter.end(span)
+        self._calls = {}
+
+        self.root.end = now
+        self.root.error = error
+        self._exporter.end(self.root)
+
+
+def _caller() -> tuple[str, str]:
+    # Returns the trace and span IDs of the caller's current OpenTelemetry span, or a new trace ID.
+    if otel_trace is not None:
+        context = otel_trace.get_current_span().get_span_context()
+        if context.is_valid:
+            return format(context.trace_id, "032x"), format(context.span_id, "016x")
+    return _new_id(16), ""
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def _timestamp(value: str) -> int:
+    # The server sends RFC 3339 times, which are parsed to the microsecond.
+    if not value:
+        return time.time_ns()
+    try:
+        return (datetime.fromisoformat(value) - _EPOCH) // datetime.resolution * 1000
+    except (TypeError, ValueError):
+        return time.time_ns()
@@ -0,0 +1,36 @@
+import platform
+import socket
+
+import httpx
+
+UNIX_SCHEME = "unix://"
+
+
+def supports_unix_sockets() -> bool:
+    return hasattr(socket, "AF_UNIX") and platform.system() != "Windows"
+
+
+def is_unix_url(url: str) -> bool:
+    return url.startswith(UNIX_SCHEME)
+
+
+def http_url(url: str) -> str:
+    # Requests sent over a Unix domain socket still need an HTTP URL, but the host is ignored by the transport.
+    return "http://localhost" if is_unix_url(url) else url
+
+
+def new_client(url: str, limits: httpx.Limits = None, timeout: httpx.Timeout = None) -> httpx.AsyncClient:
+    if limits is None:
+        limits = httpx.Limits()
+    if timeout is None:
+        # Use a timeout of 15 minutes = 15 * 60s.
+        timeout = httpx.Timeout(15 * 60.0)
+
+    if is_unix_url(url):
+        # The client ignores its limits when a transport is given, so they are set on the transport.
+        return httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(uds=url.removeprefix(UNIX_SCHEME), limits=limits),
+            timeout=timeout,
+        )
+
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
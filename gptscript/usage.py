@@ -0,0 +1,153 @@
+import threading
+import time
+from array import array
+from typing import Any
+
+from gptscript.frame import CallFrame, RunEventType, Usage
+
+# The dimensions that the ledger totals usage by, in the order they are stored.
+DIMENSIONS = ("run", "tool", "model", "context")
+_COUNTERS = ("calls", "promptTokens", "completionTokens", "totalTokens")
+
+
+class RunUsage:
+    """
+    Total the token usage of the calls of a run as its events arrive. Every frame of a call repeats its usage, so a call
+    is only counted once: when it finishes, or when the run ends if it never finished. Only the calls that haven't
+    finished are tracked, so a repeated callFinish for a call that was already counted is ignored.
+    """
+
+    def __init__(self):
+        self.runID = ""
+        # The counters of each (tool, model) pair, in the order of _COUNTERS.
+        self.rows: dict[tuple[str, str], list[int]] = {}
+        # The latest frame of each call that hasn't finished, and its model, which is only sent with the callStart frame.
+        self._open: dict[str, CallFrame] = {}
+        self._models: dict[str, str] = {}
+
+    def on_call(self, frame: CallFrame):
+        if frame.type == RunEventType.callStart:
+            self._models[frame.id] = frame.modelName()
+        if frame.type != RunEventType.callFinish:
+            self._open[frame.id] = frame
+            return
+
+        if self._open.pop(frame.id, None) is not None:
+            self._add(frame, self._models.pop(frame.id, ""))
+
+    def finish(self):
+        """Count the calls that didn't finish, with the usage of their latest frame."""
+        for frame in self._open.values():
+            self._add(frame, self._models.pop(frame.id, ""))
+        self._open = {}
+
+    def total(self) -> Usage:
+        return Usage(*(sum(row[i] for row in self.rows.values()) for i in range(1, 4)))
+
+    def calls(self) -> int:
+        return sum(row[0] for row in self.rows.values())
+
+    def byTool(self) -> dict[str, Usage]:
+        return self._by(0)
+
+    def byModel(self) -> dict[str, Usage]:
+        return self._by(1)
+
+    def _by(self, index: int) -> dict[str, Usage]:
+        totals: dict[str, Usage] = {}
+        for key, row in self.rows.items():
+            usage = totals.setdefault(key[index], Usage())
+            usage.promptTokens += row[1]
+            usage.completionTokens += row[2]
+            usage.totalTokens += row[3]
+        return totals
+
+    def _add(self, frame: CallFrame, model: str):
+        row = self.rows.setdefault((frame.toolName, model), [0, 0, 0, 0])
+        row[0] += 1
+        usage = frame.usage
+        if usage is not None:
+            row[1] += usage.promptTokens
+            row[2] += usage.completionTokens
+            row[3] += usage.totalTokens
+
+
+class UsageLedger:
+    """
+    Total token usage across runs by run, tool, model and credential context. Each distinct combination is a row of
+    parallel arrays, with the names stored once in a string table, so the ledger stays small however many calls are
+    recorded. The number of rows grows with the number of runs, so long-running processes should export snapshots with
+    reset=True.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def record(self, usage: RunUsage, context: str = "default"):
+        with self._lock:
+            run, context = self._intern(usage.runID), self._intern(context)
+            for (tool, model), counters in usage.rows.items():
+                key = (run, self._intern(tool), self._intern(model), context)
+                row = self._index.get(key)
+                if row is None:
+                    row = self._index[key] = len(self._counters[0])
+                    for column, value in zip(self._keys, key):
+                        column.append(value)
+                    for column in self._counters:
+                        column.append(0)
+                for column, value in zip(self._counters, counters):
+                    column[row] += value
+
+    def totals(self, *by: str) -> dict[tuple[str, ...], dict[str, int]]:
+        """Return the counters summed by the given dimensions, such as totals("model") or totals("tool", "context")."""
+        columns = [self._keys[DIMENSIONS.index(name)] for name in by]
+        totals: dict[tuple[str, ...], dict[str, int]] = {}
+        with self._lock:
+            for row in range(len(self._counters[0])):
+                key = tuple(self._strings[column[row]] for column in columns)
+                total = totals.get(key)
+                if total is None:
+                    total = totals[key] = dict.fromkeys(_COUNTERS, 0)
+                for name, column in zip(_COUNTERS, self._counters):
+                    total[name] += column[row]
+        return totals
+
+    def snapshot(self, reset: bool = False) -> dict[str, Any]:
+        """
+        Return every row as columns: a list per dimension and counter, plus the time of the snapshot. With reset=True
+        the ledger is cleared in the same step, so consecutive snapshots don't overlap.
+        """
+        with self._lock:
+            strings, keys, counters = self._strings, self._keys, self._counters
+            if reset:
+                self._reset()
+            else:
+                counters = [column[:] for column in counters]
+            snapshot: dict[str, Any] = {"time": time.time()}
+            for name, column in zip(DIMENSIONS, keys):
+                snapshot[name] = [strings[i] for i in column]
+            for name, column in zip(_COUNTERS, counters):
+                snapshot[name] = column.tolist()
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def __len__(self) -> int:
+        return len(self._counters[0])
+
+    def _reset(self):
+        self._strings: list[str] = []
+        self._ids: dict[str, int] = {}
+        self._index: dict[tuple[int, int, int, int], int] = {}
+        self._keys = tuple(array("I") for _ in DIMENSIONS)
+        self._counters = tuple(array("Q") for _ in _COUNTERS)
+
+    def _intern(self, value: str) -> int:
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self._strings)
+            self._strings.append(value)
+        return i
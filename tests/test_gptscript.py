@@ -1,26 +1,44 @@
+import asyncio
 import base64
 import gzip
 import json
+import math
 import os
 import platform
+import socket
 import subprocess
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
 from datetime import datetime, timedelta, timezone
 from time import sleep
 
+import httpx
 import pytest
 
+from gptscript.cache import LRUCache, RefreshCache, ResultCache
 from gptscript.confirm import AuthResponse
 from gptscript.credentials import Credential
 from gptscript.datasets import DatasetElement
+from gptscript.decoder import EventDecoder, json_backend, to_frame
+from gptscript.dispatcher import EventDispatcher
 from gptscript.exec_utils import get_env
-from gptscript.frame import RunEventType, CallFrame, RunFrame, RunState, PromptFrame
+from gptscript.frame import RunEventType, CallFrame, RunFrame, RunState, PromptFrame, LazyCallFrame, Output, Usage, \
+    CallSummary
 from gptscript.gptscript import GPTScript
 from gptscript.install import install, gptscript_binary_name, python_bin_dir
-from gptscript.opts import GlobalOptions, Options
+from gptscript.opts import GlobalOptions, Options, CallRetention
 from gptscript.prompt import PromptResponse
 from gptscript.run import Run
+from gptscript.server import SDKServer, ServerPool
+from gptscript.shared import SharedServers
+from gptscript.tracing import InMemorySpanExporter, Tracer
+from gptscript.usage import RunUsage, UsageLedger
 from gptscript.text import Text
 from gptscript.tool import ToolDef, ArgumentSchema, Property, Tool
+from gptscript.transport import http_url, new_client
 
 
 # Ensure the OPENAI_API_KEY is set for testing
@@ -97,6 +115,29 @@ def test_install():
     assert process.stdout.read().startswith('gptscript version ')
 
 
+def test_import_time():
+    def import_time(statement: str) -> dict[str, int]:
+        out = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True,
+                             check=True).stderr
+        times = {}
+        for line in out.splitlines():
+            fields = line.removeprefix("import time:").split("|")
+            if len(fields) == 3 and fields[0].strip().isdigit():
+                times[fields[2].strip()] = int(fields[0])
+        return times
+
+    light = import_time("from gptscript import get_env")
+    full = import_time("from gptscript import GPTScript")
+    assert "httpx" not in light and "pydantic" not in light, "Expected get_env not to import httpx or pydantic"
+    assert "pydantic" not in full, "Expected GPTScript not to import pydantic until it is needed"
+    assert sum(light.values()) < sum(full.values()) / 2, \
+        f"Expected a fast import of get_env: {sum(light.values())}us, GPTScript: {sum(full.values())}us"
+
+    # Submodules are still available as attributes of the package.
+    statement = "import gptscript; gptscript.opts.Options; gptscript.frame.RunState"
+    subprocess.run([sys.executable, "-c", statement], check=True)
+
+
 @pytest.mark.asyncio
 async def test_create_another_gptscript():
     g = GPTScript()
@@ -105,18 +146,260 @@ async def test_create_another_gptscript():
     assert "gptscript version" in version
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(platform.system().lower() == "windows", reason="This test uses a shell script as the binary")
+async def test_async_create(gptscript, tmp_path, monkeypatch):
+    g = await GPTScript.create(GlobalOptions(apiKey=os.getenv("OPENAI_API_KEY")))
+    try:
+        assert "gptscript version" in await g.version()
+        await SDKServer(g.opts.URL).wait_ready(timeout=5)
+    finally:
+        g.close()
+
+    silent = tmp_path / "silent"
+    silent.write_text("#!/bin/sh\nsleep 5\n")
+    silent.chmod(0o755)
+    monkeypatch.setenv("GPTSCRIPT_BIN", str(silent))
+    with pytest.raises(TimeoutError):
+        await asyncio.to_thread(SDKServer.start, {}, "", 0.2)
+
+
 @pytest.mark.asyncio
 async def test_version(gptscript):
     v = await gptscript.version()
     assert "gptscript version " in v
 
 
+@pytest.mark.asyncio
+async def test_basic_commands_reuse_client(gptscript):
+    client = gptscript._http_client()
+    for _ in range(3):
+        assert "gptscript version " in await gptscript.version()
+    assert gptscript._http_client() is client, "Expected basic commands to reuse the shared client"
+    assert not client.is_closed, "Expected the shared client to stay open between commands"
+
+
+def test_clients_replaced_in_new_loop():
+    async def client() -> httpx.AsyncClient:
+        return g._http_client()
+
+    g = GPTScript(GlobalOptions(url="http://127.0.0.1:1"))
+    loop = asyncio.new_event_loop()
+    try:
+        # The first loop is stopped but not closed while another loop runs in the same thread.
+        first = loop.run_until_complete(client())
+        assert asyncio.run(client()) is not first, "Expected a new client for the new loop"
+    finally:
+        g.close()
+        loop.close()
+
+
+def test_clients_per_loop(gptscript):
+    # Loops in other threads get their own clients, and don't close the clients of loops that are still running.
+    versions = []
+    threads = [threading.Thread(target=lambda: versions.append(asyncio.run(gptscript.version()))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(versions) == 4 and all("gptscript version" in v for v in versions), "Expected every thread to succeed"
+
+
+@pytest.mark.asyncio
+async def test_coalesce_basic_commands(gptscript):
+    sent = []
+    send = gptscript._send_basic_command
+
+    async def count(sub_command, request_body=None, route=""):
+        sent.append(sub_command)
+        return await send(sub_command, request_body, route)
+
+    gptscript._send_basic_command = count
+    try:
+        versions = await asyncio.gather(*[gptscript.version() for _ in range(10)])
+        await asyncio.gather(*[gptscript.fmt([]), gptscript.fmt([]), gptscript.confirm(AuthResponse(id="1"))])
+    finally:
+        del gptscript._send_basic_command
+
+    assert len(set(versions)) == 1, "Expected every caller to get the same version"
+    assert sent.count("version") == 1, "Expected concurrent version calls to share one request"
+    assert sent.count("fmt") == 1, "Expected concurrent fmt calls to share one request"
+    assert sent.count("confirm/1") == 1, "Expected the confirm to be sent"
+    assert gptscript._inflight == {}, "Expected no requests left in flight"
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(platform.system().lower() == "windows", reason="Unix domain sockets are not supported on Windows")
+async def test_unix_socket_client():
+    assert http_url("unix:///tmp/gptscript.sock") == "http://localhost", "Unexpected URL for Unix domain socket"
+    assert http_url("http://127.0.0.1:9090") == "http://127.0.0.1:9090", "Unexpected URL for TCP"
+
+    client = new_client("unix:///tmp/gptscript.sock")
+    try:
+        assert client._transport._pool._uds == "/tmp/gptscript.sock", "Expected client to use the Unix domain socket"
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.skipif(platform.system().lower() == "windows", reason="Unix domain sockets are not supported on Windows")
+def test_unix_socket_server(tmp_path):
+    path = str(tmp_path / "gptscript.sock")
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+
+    # A socket left behind by a server that exited is replaced.
+    server = SDKServer.start(dict(os.environ), path)
+    assert server.url == "unix://" + path, "Expected the server to listen on the stale socket path"
+    server.stop()
+    assert not os.path.exists(path), "Expected the server's socket to be removed"
+
+    # A socket another process is listening on is left alone, and the server falls back to TCP.
+    with socket.socket(socket.AF_UNIX) as live:
+        live.bind(path)
+        live.listen()
+        server = SDKServer.start(dict(os.environ), path)
+        server.stop()
+        assert server.url.startswith("http://"), "Expected a TCP server when the socket is in use"
+        assert os.path.exists(path), "Expected the other process's socket to be kept"
+
+
+def test_server_pool_routing():
+    servers = [SDKServer("http://127.0.0.1:1"), SDKServer("http://127.0.0.1:2")]
+    pool = ServerPool(servers)
+
+    servers[0].outstanding = 1
+    assert pool.pick() is servers[1], "Expected the server with the fewest outstanding requests"
+    assert pool.pick() is servers[1], "Expected the server with the fewest outstanding requests"
+
+    servers[0].routes.add("call-id")
+    assert pool.route("call-id") is servers[0], "Expected responses to be routed to the server waiting on them"
+    assert "call-id" not in servers[0].routes, "Expected the route to be removed once used"
+
+
+@pytest.mark.skipif(platform.system().lower() == "windows", reason="Shared servers are not supported on Windows")
+def test_shared_servers(tmp_path):
+    started = []
+
+    def start() -> ServerPool:
+        started.append(SDKServer(f"http://127.0.0.1:{len(started) + 1}"))
+        return ServerPool([started[-1]])
+
+    path = str(tmp_path / "servers.json")
+    owner = SharedServers(path, start)
+    assert owner.attach().servers[0] is started[0], "Expected the first process to start the servers"
+    assert SharedServers(path, start).attach().servers[0].url == started[0].url, "Expected to attach to the servers"
+    assert len(started) == 1, "Expected the servers to be started once"
+
+    # The owner records the new URL of a server it restarted, and attached processes pick it up.
+    attached = SharedServers(path, start)
+    pool = attached.attach()
+    assert attached.refresh(pool) is None, "Expected no refresh while the servers are unchanged"
+    owner.update(ServerPool([SDKServer("http://127.0.0.1:9")]))
+    refreshed = attached.refresh(pool)
+    assert refreshed is not None and refreshed.servers[0].url == "http://127.0.0.1:9", "Expected the new server URL"
+    assert refreshed.metrics is pool.metrics, "Expected the metrics to be kept"
+
+    # Another live process is attached, so the owner doesn't stop the servers.
+    with open(path) as f:
+        state = json.load(f)
+    with open(path, "w") as f:
+        json.dump({**state, "clients": [os.getppid()]}, f)
+    assert not owner.detach(), "Expected the servers to be kept for the other process"
+
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    with open(path, "w") as f:
+        json.dump({**state, "owner": dead.pid}, f)
+    assert SharedServers(path, start).attach().servers[0] is started[1], "Expected to take over from a dead owner"
+    assert SharedServers(path, start).detach(), "Expected the last process to stop the servers"
+
+
+def test_server_supervisor(monkeypatch):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    server = SDKServer("http://127.0.0.1:1", dead)
+    attempts = []
+
+    def restart():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise Exception("failed to start")
+        server.process = subprocess.Popen([sys.executable, "-c", "import sys; sys.stdin.read()"], stdin=subprocess.PIPE)
+        server.started = time.monotonic()
+
+    monkeypatch.setattr(server, "restart", restart)
+    pool = ServerPool([server], backoff=0.05)
+    restarted = []
+    pool.supervise(0.01, restarted.append)
+    try:
+        deadline = time.monotonic() + 5
+        while not restarted and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert restarted == [pool] and server.alive(), "Expected the supervisor to restart the crashed server"
+        assert attempts[1] - attempts[0] >= 0.1, "Expected the restart to back off after failing"
+        metrics = pool.metrics
+        assert (metrics.crashes, metrics.restarts, metrics.failedRestarts) == (1, 1, 1), "Unexpected server metrics"
+    finally:
+        pool.stop()
+    assert not server.alive(), "Expected the server to be stopped"
+
+    # Without a supervisor, pick restarts the server on another thread instead of blocking its caller.
+    def slow_restart():
+        time.sleep(0.2)
+        restart()
+
+    monkeypatch.setattr(server, "restart", slow_restart)
+    server.crashed, server.started = False, 0.0
+    pool = ServerPool([server], backoff=0.05)
+    restarted = []
+    pool.supervise(0, restarted.append)
+    try:
+        start = time.monotonic()
+        assert pool.pick() is server and time.monotonic() - start < 0.1, "Expected pick not to wait for the restart"
+        deadline = time.monotonic() + 5
+        while not restarted and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert restarted == [pool] and server.alive(), "Expected the server to be restarted in the background"
+    finally:
+        pool.stop()
+
+
 @pytest.mark.asyncio
 async def test_list_models(gptscript):
     models = await gptscript.list_models()
     assert isinstance(models, list) and len(models) > 1, "Expected list_models to return a list"
 
 
+@pytest.mark.asyncio
+async def test_list_models_cache():
+    fetched = 0
+
+    async def fetch():
+        nonlocal fetched
+        fetched += 1
+        await asyncio.sleep(0.01)
+        return fetched
+
+    cache = RefreshCache(lambda _: (time.time() + 0.2, math.inf))
+    assert await asyncio.gather(cache.get("k", fetch), cache.get("k", fetch)) == [1, 1], "Expected a shared fetch"
+    await asyncio.sleep(0.3)
+    assert await cache.get("k", fetch) == 1, "Expected the stale value while it is refreshed"
+    await asyncio.sleep(0.05)
+    assert await cache.get("k", fetch) == 2, "Expected the refreshed value"
+    cache.invalidate()
+    assert await cache.get("k", fetch) == 3, "Expected an invalidated value to be fetched"
+    assert (cache.hits, cache.misses, cache.refreshes) == (2, 3, 1), "Unexpected model cache counters"
+
+    gptscript = GPTScript(GlobalOptions(modelCacheTTL=60))
+    try:
+        models = await gptscript.list_models()
+        assert [m.id for m in await gptscript.list_models()] == [m.id for m in models], "Expected the cached models"
+        assert gptscript.model_cache().hits == 1, "Expected a model cache hit"
+    finally:
+        gptscript.close()
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(os.environ.get("ANTHROPIC_API_KEY") is None, reason="ANTHROPIC_API_KEY not set")
 async def test_list_models_from_provider(gptscript):
@@ -259,6 +542,69 @@ async def test_stream_exec_complex_tool(gptscript, complex_tool):
     assert '"artists":' in stream_output, "Expected stream_output to have output"
 
 
+@pytest.mark.asyncio
+async def test_run_events(gptscript, simple_tool):
+    run = gptscript.evaluate(simple_tool, Options(disableCache=True, eventQueueSize=1))
+    event_types = [e.type async for e in run.events()]
+    assert "Washington" in await run.text(), "Unexpected response for tool run"
+    assert event_types[0] == RunEventType.runStart, "Expected the first event to be runStart"
+    assert event_types[-1] == RunEventType.runFinish, "Expected the last event to be runFinish"
+    assert RunEventType.callFinish in event_types, "Expected a callFinish event"
+
+
+@pytest.mark.asyncio
+async def test_run_events_overflow():
+    async def events():
+        for i in range(3):
+            yield b'data: {"call": {"id": "%d", "type": "callProgress"}}\n\n' % i
+        yield b'data: {"stdout": {"state": {}, "content": "done", "done": true}}\n\n'
+
+    global_opts = GlobalOptions(url="http://localhost", env=[])
+    for overflow, expected in [("dropNewest", ["0", "1"]), ("dropOldest", ["1", "2"])]:
+        opts = Options(eventQueueSize=2, eventOverflow=overflow).merge_global_opts(global_opts)
+        client = httpx.AsyncClient(transport=httpx.MockTransport(lambda _: httpx.Response(200, content=events())))
+        run = Run("evaluate", ToolDef(), opts, client=client).next_chat()
+        queued = run.events()
+        assert await run.text() == "done", "Unexpected run output"
+        assert [e.id async for e in queued] == expected, f"Unexpected events with {overflow}"
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(platform.system().lower() == "windows", reason="This test uses a bash tool")
+async def test_evaluate_batch(gptscript):
+    tools = [
+        ToolDef(tools=["fail"], instructions="#!/bin/bash\necho ${GPTSCRIPT_INPUT}"),
+        ToolDef(name="fail", instructions="#!/bin/bash\nexit 1"),
+    ]
+    inputs = [str(i) for i in range(6)]
+
+    results = [r async for r in gptscript.evaluate_batch(tools[:1], inputs, concurrency=2, ordered=True)]
+    assert [r.index for r in results] == list(range(6)), "Expected results in input order"
+    assert [r.output.strip() for r in results] == inputs, "Unexpected output from batch"
+    assert all(r.error == "" for r in results), "Unexpected error from batch"
+
+    results = [r async for r in gptscript.evaluate_batch(tools, inputs, Options(subTool="fail"), concurrency=3)]
+    assert sorted(r.index for r in results) == list(range(6)), "Expected a result for every input"
+    assert all(r.error != "" for r in results), "Expected every run in the batch to fail"
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(platform.system().lower() == "windows", reason="This test uses a bash tool")
+async def test_result_cache(gptscript):
+    tool = ToolDef(instructions="#!/bin/bash\necho ${GPTSCRIPT_INPUT} $(date +%s%N)")
+    hits = gptscript.result_cache().hits
+
+    out = await gptscript.evaluate(tool, Options(input="cached", resultCache=True)).text()
+    run = gptscript.evaluate(tool, Options(input="cached", resultCache=True))
+    assert run.state() == RunState.Finished, "Expected a cached run to finish immediately"
+    assert await run.text() == out, "Expected the cached output"
+    assert gptscript.result_cache().hits == hits + 1, "Expected a cache hit"
+
+    assert await gptscript.evaluate(tool, Options(input="cached")).text() != out, "Expected an uncached run"
+    assert await gptscript.evaluate(tool, Options(input="other", resultCache=True)).text() != out, \
+        "Expected a different input to miss the cache"
+
+
 @pytest.mark.asyncio
 async def test_simple_run_file(gptscript):
     cwd = os.getcwd().removesuffix("/tests")
@@ -362,6 +708,34 @@ async def test_parse_simple_file(gptscript):
         "Unexpected output from parsing simple file"
 
 
+@pytest.mark.asyncio
+async def test_parse_load_cache(gptscript, tmp_path):
+    file = tmp_path / "test.gpt"
+    file.write_text("Who was the president of the United States in 1986?")
+    cache = gptscript.load_cache()
+    hits, misses = cache.hits, cache.misses
+
+    tools = await gptscript.parse(str(file))
+    tools[0].instructions = "edited"
+    cached = await gptscript.parse(str(file))
+    assert (cache.hits, cache.misses) == (hits + 1, misses + 1), "Expected the second parse to come from the cache"
+    assert cached[0].instructions != "edited", "Expected changes to returned nodes not to affect the cache"
+
+    await gptscript.parse(str(file), disable_cache=True)
+    assert (cache.hits, cache.misses) == (hits + 1, misses + 1), "Expected disable_cache to bypass the load cache"
+
+    file.write_text("Who was the president of the United States in 1987?")
+    await gptscript.parse(str(file))
+    assert cache.misses == misses + 2, "Expected a changed file to miss the cache"
+
+    cache.invalidate(str(file))
+    await gptscript.parse(str(file))
+    assert cache.misses == misses + 3, "Expected an invalidated file to miss the cache"
+
+    await gptscript.parse_content("Say hello!", disable_cache=True)
+    assert cache.misses == misses + 3, "Expected disable_cache to bypass the load cache for content"
+
+
 @pytest.mark.asyncio
 async def test_parse_empty_file(gptscript):
     wd = os.getcwd()
@@ -716,6 +1090,338 @@ async def test_prompt_without_prompt_allowed(gptscript):
     assert "prompt event occurred" in out, "Unexpected output: " + out
 
 
+def test_event_decoder_benchmark():
+    event = {"call": {
+        "id": "call_1",
+        "type": "callProgress",
+        "toolName": "main",
+        "tool": {"id": "tool_1", "instructions": "Do the thing. " * 10, "modelName": "gpt-4o", "tools": ["sys.exec"]},
+        "output": [{"content": "hello world " * 20}],
+        "usage": {"promptTokens": 10, "completionTokens": 5, "totalTokens": 15},
+        "llmRequest": {"messages": [{"role": "user", "content": "x" * 50} for _ in range(20)]},
+    }}
+    payload = b"".join(b"data: " + json.dumps(event).encode() + b"\n\n" for _ in range(5000)) + b'data: "[DONE]"\n\n'
+    # Use an odd chunk size so that events are split across chunks.
+    chunks = [payload[i:i + 4093] for i in range(0, len(payload), 4093)]
+
+    def decode_lines():
+        out = []
+        for line in payload.decode("utf-8").split("\n"):
+            line = line.strip().removeprefix("data: ").strip()
+            if line == '' or line == '"[DONE]"':
+                continue
+            out.append(json.loads(line))
+        return out
+
+    def decode_bytes():
+        decoder, out = EventDecoder(), []
+        for chunk in chunks:
+            out.extend(decoder.feed(chunk))
+        out.extend(decoder.flush())
+        return out
+
+    assert decode_bytes() == decode_lines(), "Expected both decoders to produce the same events"
+
+    lines_time = min(timeit.repeat(decode_lines, number=1, repeat=5))
+    bytes_time = min(timeit.repeat(decode_bytes, number=1, repeat=5))
+    print(f"decoded 5000 events: lines+json {lines_time:.4f}s, bytes+{json_backend} {bytes_time:.4f}s")
+    if json_backend != "json":
+        assert bytes_time < lines_time, f"Expected decoding with {json_backend} to be faster"
+
+
+def test_lazy_call_frame():
+    data = {"call": {
+        "id": "call_1",
+        "type": "callProgress",
+        "toolCategory": "",
+        "tool": {"id": "tool_1", "instructions": "echo hello", "modelName": "gpt-4o"},
+        "output": [{"content": "hello"}],
+        "usage": {"promptTokens": 1, "completionTokens": 2, "totalTokens": 3},
+        "llmRequest": {"messages": []},
+        "llmResponse": {"content": "hello"},
+    }}
+
+    frame = to_frame(data, lazy=True, drop_llm_payloads=True)
+    assert isinstance(frame, LazyCallFrame), "Expected a lazy call frame"
+    assert frame.type == RunEventType.callProgress, "Unexpected type for lazy call frame"
+    assert "output" in frame._raw, "Expected output to not be built before it is accessed"
+    assert isinstance(frame.output[0], Output) and frame.output[0].content == "hello", "Unexpected lazy output"
+    assert "output" not in frame._raw, "Expected the raw output to be released once built"
+    assert frame.usage.totalTokens == 3, "Unexpected lazy usage"
+    assert frame.modelName() == "gpt-4o" and "tool" in frame._raw, "Expected the model without building the tool"
+    assert frame.tool["instructions"] == "echo hello", "Expected the lazy tool to be a dict, as in CallFrame"
+    assert frame.llmRequest is None and frame.llmResponse is None, "Expected LLM payloads to be dropped"
+    assert frame.modelName() == "gpt-4o", "Expected the model from the accessed tool"
+
+    fields = vars(to_frame(data, lazy=True, drop_llm_payloads=False))
+    assert set(fields) == set(vars(CallFrame())), "Expected vars() to have the fields of a CallFrame"
+    assert fields["output"][0].content == "hello" and fields["toolName"] == "", "Unexpected fields from vars()"
+
+
+def test_compact_subclass():
+    class MyTool(ToolDef):
+        pass
+
+    class MyFrame(CallFrame):
+        pass
+
+    assert MyTool(instructions="x").to_json()["instructions"] == "x", "Expected the fields of a subclass in to_json"
+    assert vars(MyFrame(id="1"))["id"] == "1", "Expected the fields of a subclass in vars()"
+
+
+def test_frame_memory_benchmark():
+    def dict_backed(cls):
+        # A copy of the class that keeps its attributes in a per-instance __dict__, like the frames did before.
+        return type(cls.__name__, (), {"__init__": cls.__init__})
+
+    def measure(call_frame, output, usage) -> int:
+        tracemalloc.start()
+        calls = {
+            f"call_{i}": call_frame(
+                id=f"call_{i}",
+                type="callFinish",
+                toolName="main",
+                output=[output(content="done")],
+                usage=usage(promptTokens=1, completionTokens=2, totalTokens=3),
+            )
+            for i in range(10000)
+        }
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(calls) == 10000
+        return size
+
+    dict_size = measure(dict_backed(CallFrame), dict_backed(Output), dict_backed(Usage))
+    slots_size = measure(CallFrame, Output, Usage)
+    print(f"10k call frames: __dict__ {dict_size / 1024:.0f} KiB, __slots__ {slots_size / 1024:.0f} KiB")
+    assert slots_size < dict_size, "Expected slotted frames to use less memory"
+
+
+def test_env_request_size():
+    global_opts = GlobalOptions(env=[f"{k}={v}" for k, v in os.environ.items()] + ["OPENAI_API_KEY=global"])
+    global_env = list(global_opts.Env)
+    opts = Options(env=[f"{k}={v}" for k, v in os.environ.items()] + ["OPENAI_API_KEY=run"])
+
+    before = len(json.dumps(global_opts.Env + opts.Env))
+    for _ in range(3):
+        merged = opts.merge_global_opts(global_opts)
+    after = len(json.dumps(Run("evaluate", ToolDef(), merged)._request_body()["Env"]))
+
+    assert global_opts.Env == global_env, "Expected merging not to change the global env"
+    assert "OPENAI_API_KEY=run" in merged.Env and "OPENAI_API_KEY=global" not in merged.Env, \
+        "Expected the run env to override the global env"
+    assert len(merged.Env) == len({e.split("=", 1)[0] for e in merged.Env}), "Expected every variable to be sent once"
+    assert after < before * 0.6, f"Expected a smaller env in the request body, {before} bytes before, {after} after"
+
+
+def test_run_request_body():
+    opts = Options(input="input", env=["KEY=value"], lazyFrames=True, handlerConcurrency=5, url="http://127.0.0.1:1",
+                   token="token")
+    body = Run("evaluate", ToolDef(instructions="echo"), opts)._request_body()
+
+    assert set(body) == {"toolDefs", "input", "Env"}, "Expected only the options the server reads that are set"
+    assert len(json.dumps(body)) < len(json.dumps({"toolDefs": body["toolDefs"], **vars(opts)})) / 2, \
+        "Expected a smaller request body"
+
+
+def test_call_retention():
+    def frames():
+        return [
+            CallFrame(id="1", type="callStart"),
+            CallFrame(id="2", type="callStart", parentID="1"),
+            CallFrame(id="2", type="callFinish", parentID="1"),
+            CallFrame(id="3", type="callStart", parentID="1"),
+            CallFrame(id="3", type="callFinish", parentID="1", usage={"totalTokens": 3}),
+        ]
+
+    run = Run("evaluate", ToolDef(), Options(callRetention=CallRetention.recent, finishedCallsLimit=1))
+    for frame in frames():
+        run._retain_call(frame)
+    assert set(run.calls()) == {"1", "3"}, "Expected the in-flight call and the latest finished call"
+
+    run = Run("evaluate", ToolDef(), Options(callRetention="summary"))
+    for frame in frames():
+        run._retain_call(frame)
+    assert set(run.calls()) == {"1", "2", "3"}, "Expected a summary for every call"
+    assert isinstance(run.calls()["3"], CallSummary), "Expected call summaries"
+    assert run.calls()["3"].usage.totalTokens == 3, "Unexpected usage in call summary"
+
+
+@pytest.mark.asyncio
+async def test_run_timeouts():
+    def client(delays: list[float]) -> httpx.AsyncClient:
+        async def events():
+            for delay in delays:
+                await asyncio.sleep(delay)
+                yield b'data: {"stderr": "working"}\n\n'
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(lambda _: httpx.Response(200, content=events())))
+
+    cases = [
+        ([1], Options(firstEventTimeout=0.1), "first event"),
+        ([0, 0.05, 1], Options(idleTimeout=0.2), "without an event"),
+        ([0, 0.1, 0.1, 0.1, 1], Options(idleTimeout=0.5, runTimeout=0.25), "after 0.25s"),
+    ]
+    global_opts = GlobalOptions(url="http://localhost", env=[])
+    for delays, opts, reason in cases:
+        run = Run("evaluate", ToolDef(), opts.merge_global_opts(global_opts), client=client(delays)).next_chat()
+        with pytest.raises(Exception, match=reason):
+            await run.text()
+        assert run.state() == RunState.Timeout, "Expected the run to end in the timeout state"
+
+    run = Run("evaluate", ToolDef(), Options(idleTimeout=0.2).merge_global_opts(global_opts), client=client([0, 0.05]))
+    run = run.next_chat()
+    await run.text()
+    assert run.state() == RunState.Finished, "Expected a run within its timeouts to finish"
+
+    # A connect timeout of 0 means no limit, rather than the client's request timeout.
+    timeouts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        timeouts.append(request.extensions["timeout"]["connect"])
+        return httpx.Response(200, content=b'data: {"stdout": {"state": {}, "content": "", "done": true}}\n\n')
+
+    for connect, expected in [(0, None), (2, 2)]:
+        opts = Options(connectTimeout=connect).merge_global_opts(global_opts)
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler), timeout=5)
+        await Run("evaluate", ToolDef(), opts, client=client).next_chat().text()
+        assert timeouts.pop() == expected, f"Unexpected connect timeout for connectTimeout={connect}"
+
+    # Waiting for a slow consumer doesn't count towards the idle timeout.
+    async def burst():
+        yield b'data: {"call": {"id": "1", "type": "callProgress"}}\n\n' * 3
+        yield b'data: {"stdout": {"state": {}, "content": "done", "done": true}}\n\n'
+
+    opts = Options(idleTimeout=0.2, eventQueueSize=1).merge_global_opts(global_opts)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda _: httpx.Response(200, content=burst())))
+    run = Run("evaluate", ToolDef(), opts, client=client).next_chat()
+    async for _ in run.events():
+        await asyncio.sleep(0.5)
+    assert await run.text() == "done", "Expected a run with a slow consumer to finish"
+    assert run.state() == RunState.Finished, "Expected a run with a slow consumer to finish"
+
+
+@pytest.mark.asyncio
+async def test_run_metrics():
+    async def events():
+        yield b'data: {"run": {"id": "1", "type": "runStart"}}\n\n'
+        await asyncio.sleep(0.05)
+        yield b'data: {"call": {"id": "2", "type": "callProgress"}}\n\n' * 2
+        yield b'data: {"stdout": {"state": {}, "content": "done", "done": true}}\n\n'
+
+    async def handler(_, __):
+        await asyncio.sleep(0.05)
+
+    reported = []
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda _: httpx.Response(200, content=events())))
+    global_opts = GlobalOptions(url="http://localhost", env=[], metricsHandler=lambda _, m: reported.append(m))
+    opts = Options().merge_global_opts(global_opts)
+    run = Run("evaluate", ToolDef(), opts, event_handlers=[handler], client=client).next_chat()
+    assert await run.text() == "done", "Unexpected run output"
+
+    metrics = run.metrics()
+    assert reported == [metrics], "Expected the metrics handler to be called once"
+    assert metrics.events == {RunEventType.runStart: 1, RunEventType.callProgress: 2}, "Unexpected event counts"
+    assert metrics.bytes > 0 and metrics.decodeTime > 0, "Expected the bytes and decoding time to be counted"
+    assert metrics.timeToFirstByte < 0.05 <= metrics.timeToFirstProgress < metrics.duration, "Unexpected timings"
+    assert metrics.handlerTime < 0.05, "Expected handler time to exclude the time handlers were suspended"
+
+
+@pytest.mark.asyncio
+async def test_tracing():
+    frames = [
+        {"id": "1", "type": "callStart", "toolName": "main", "start": "2024-01-01T00:00:00Z"},
+        {"id": "2", "type": "callStart", "toolName": "sub", "parentID": "1", "start": "2024-01-01T00:00:01Z",
+         "tool": {"modelName": "gpt-4o"}},
+        {"id": "2", "type": "callProgress", "toolName": "sub", "parentID": "1"},
+        {"id": "2", "type": "callFinish", "toolName": "sub", "parentID": "1", "end": "2024-01-01T00:00:02Z",
+         "usage": {"promptTokens": 3, "completionTokens": 2, "totalTokens": 5}, "chatResponseCached": True},
+        {"id": "3", "type": "callStart", "toolName": "unfinished", "parentID": "1"},
+    ]
+
+    async def events():
+        for frame in frames:
+            yield b"data: " + json.dumps({"call": frame}).encode() + b"\n\n"
+
+    exporter = InMemorySpanExporter()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda _: httpx.Response(200, content=events())))
+    opts = Options().merge_global_opts(GlobalOptions(url="http://localhost", env=[], tracer=Tracer(exporter)))
+    await Run("evaluate", ToolDef(), opts, client=client).next_chat().text()
+
+    spans = {span.name: span for span in exporter.spans}
+    assert list(spans) == ["sub", "unfinished", "main", "gptscript.evaluate"], "Expected spans in the order they ended"
+    assert len({span.traceId for span in exporter.spans}) == 1, "Expected the spans to share a trace"
+    assert spans["main"].parentId == spans["gptscript.evaluate"].spanId, "Expected calls to be nested under the run"
+    assert spans["sub"].parentId == spans["main"].spanId, "Expected sub-calls to be nested under their caller"
+    assert spans["sub"].end - spans["sub"].start == 1_000_000_000, "Expected the call times from the frames"
+    assert spans["sub"].attributes["gen_ai.usage.total_tokens"] == 5, "Expected the token usage"
+    assert spans["sub"].attributes["gen_ai.request.model"] == "gpt-4o", "Expected the model"
+    assert spans["sub"].attributes["gptscript.chat_response_cached"], "Expected the cache hit"
+    assert spans["unfinished"].error != "" and spans["main"].error != "", "Expected unfinished calls to be errors"
+
+
+def test_usage_ledger():
+    def frame(id: str, type: str, tokens: int, **kwargs) -> CallFrame:
+        return CallFrame(id=id, type=type, toolName="tool" + id, usage={"promptTokens": tokens, "totalTokens": tokens},
+                         **kwargs)
+
+    ledger = UsageLedger()
+    for run_id, context in [("r1", "default"), ("r2", "work")]:
+        usage = RunUsage()
+        usage.runID = run_id
+        usage.on_call(frame("1", "callStart", 0, tool={"modelName": "gpt-4o"}))
+        for tokens in (1, 2, 3):
+            usage.on_call(frame("1", "callProgress", tokens))
+        usage.on_call(frame("1", "callFinish", 3))
+        usage.on_call(frame("1", "callFinish", 3))
+        usage.on_call(frame("2", "callProgress", 4))
+        usage.finish()
+
+        assert usage.calls() == 2, "Expected each call to be counted once"
+        assert usage.total().promptTokens == 7, "Expected the final usage of each call"
+        assert usage.byModel()["gpt-4o"].totalTokens == 3, "Expected the model from the first frame of the call"
+        ledger.record(usage, context)
+
+    assert len(ledger) == 4, "Expected a row per run, tool, model and context"
+    assert ledger.totals("model")[("gpt-4o",)]["calls"] == 2, "Unexpected totals by model"
+    assert ledger.totals("context")[("work",)]["promptTokens"] == 7, "Unexpected totals by context"
+    assert ledger.totals()[()]["totalTokens"] == 14, "Unexpected overall totals"
+
+    snapshot = ledger.snapshot(reset=True)
+    assert snapshot["run"] == ["r1", "r1", "r2", "r2"] and snapshot["tool"] == ["tool1", "tool2"] * 2, "Unexpected rows"
+    assert snapshot["calls"] == [1, 1, 1, 1], "Unexpected call counts"
+    assert len(ledger) == 0 and ledger.totals() == {}, "Expected the snapshot to reset the ledger"
+
+
+@pytest.mark.asyncio
+async def test_event_dispatcher():
+    handled, active, peak = {}, 0, 0
+
+    async def handler(run: Run, e: CallFrame | RunFrame | PromptFrame):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.001 * (3 - int(e.id)))
+        handled.setdefault(e.id, []).append(e.input)
+        active -= 1
+
+    async def slow_handler(run: Run, e: CallFrame | RunFrame | PromptFrame):
+        await asyncio.sleep(1)
+
+    dispatcher = EventDispatcher(None, [handler, slow_handler], concurrency=2, timeout=0.01, max_pending=4)
+    for i in range(5):
+        for call_id in ("1", "2", "3"):
+            await dispatcher.dispatch(CallFrame(id=call_id, input=str(i)))
+    await dispatcher.wait()
+
+    for call_id in ("1", "2", "3"):
+        assert handled[call_id] == ["0", "1", "2", "3", "4"], "Expected events of a call to be handled in order"
+    assert peak <= 2, "Expected at most two events to be handled at once"
+    assert dispatcher.metrics.events == 15, "Unexpected number of handled events"
+    assert dispatcher.metrics.timeouts == 15, "Expected the slow handler to time out"
+    assert isinstance(dispatcher.metrics.lastError, TimeoutError), "Expected the timeout to be recorded"
+
+
 def test_get_env():
     os.environ['TEST_ENV'] = json.dumps({
         '_gz': base64.b64encode(gzip.compress(b'test value')).decode('utf-8'),
@@ -764,6 +1470,37 @@ async def test_credentials(gptscript):
     assert not res.startswith("an error occurred"), "Unexpected error deleting credential: " + res
 
 
+@pytest.mark.asyncio
+async def test_credential_cache():
+    g = GPTScript(GlobalOptions(apiKey=os.getenv("OPENAI_API_KEY"), credentialCacheTTL=60))
+    sent = []
+    send = g._send_basic_command
+
+    async def count(sub_command, request_body=None, route=""):
+        sent.append(sub_command)
+        return await send(sub_command, request_body, route)
+
+    g._send_basic_command = count
+    name = "test-" + str(os.urandom(4).hex())
+    try:
+        await g.create_credential(Credential(toolName=name, env={"TEST": "test"},
+                                             expiresAt=datetime.now() + timedelta(hours=1)))
+        first = await g.reveal_credential(name=name)
+        assert await g.reveal_credential(name=name) is first, "Expected the cached credential"
+        assert sent.count("credentials/reveal") == 1, "Expected a single reveal request"
+
+        await g.delete_credential(name=name)
+        await g.reveal_credential(name=name)
+        assert sent.count("credentials/reveal") == 2, "Expected delete_credential to invalidate the credential"
+
+        refresh_at, expires_at = g._credential_expiry(Credential(expiresAt=datetime.now() + timedelta(seconds=30)))
+        assert expires_at < time.time(), "Expected a credential within the expiry margin not to be cached"
+        refresh_at, expires_at = g._credential_expiry(Credential(expiresAt=datetime.now() + timedelta(seconds=90)))
+        assert refresh_at < time.time() < expires_at, "Expected a credential about to expire to be refreshed"
+    finally:
+        g.close()
+
+
 @pytest.mark.asyncio
 async def test_datasets(gptscript):
     os.environ["GPTSCRIPT_WORKSPACE_ID"] = await gptscript.create_workspace("directory")
@@ -930,3 +1667,32 @@ async def test_ls_complex_workspace_s3(gptscript):
     assert len(files) == 2
 
     await gptscript.delete_workspace(workspace_id)
+
+
+def test_result_cache_tiers(tmp_path):
+    lru = LRUCache(max_bytes=10)
+    lru.put("a", "a", size=6)
+    lru.put("b", "b", size=6)
+    assert "a" not in lru and lru.get("b") == "b", "Expected the least recently used entry to be evicted"
+    lru.put("c", "c", ttl=0.001)
+    sleep(0.01)
+    assert lru.get("c") is None, "Expected an expired entry to be a miss"
+
+    cache = ResultCache(max_bytes=0, directory=str(tmp_path), max_disk_bytes=200)
+    cache.put("a", {"output": "a" * 100})
+    sleep(0.01)
+    cache.put("b", {"output": "b" * 100})
+    assert ResultCache(directory=str(tmp_path)).get("b") == {"output": "b" * 100}, "Expected a hit from the disk"
+    assert not (tmp_path / "a.json").exists(), "Expected the oldest result to be evicted from the disk"
+
+    # Another process sharing the directory evicts the entries of this one, which are read again before evicting.
+    sleep(0.01)
+    ResultCache(max_bytes=0, directory=str(tmp_path), max_disk_bytes=200).put("c", {"output": "c" * 100})
+    assert not (tmp_path / "b.json").exists(), "Expected the other cache to evict the oldest result"
+
+    async def put_in_background():
+        cache.put("d", {"output": "d" * 100}, background=True)
+
+    sleep(0.01)
+    asyncio.run(put_in_background())
+    assert sorted(os.listdir(tmp_path)) == ["d.json"], "Expected the results of the other cache to be counted"